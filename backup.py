@@ -2,18 +2,34 @@
 # backup.py v4.8 - Clean, stable, Python 3.8+
 
 import argparse
+import codecs
+import contextlib
 import getpass
+import fnmatch
+import glob
+import http.client
+import json
 import logging
 import os
 import re
+import selectors
 import shlex
+import shutil
+import signal
 import socket
+import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from functools import partial, wraps
 from pathlib import Path
 from shutil import which
+from typing import Optional
 
 REQUIRED_PKGS = ["borgbackup", "parted", "dosfstools", "e2fsprogs"]
 BASE_EXCLUDES = [
@@ -49,6 +65,90 @@ DEFAULT_RESTORE_EXCLUDES = [
 
 STATE_DIR = Path("/root/.backup.py")
 STATE_DIR.mkdir(parents=True, exist_ok=True)
+# Метрики текущего запуска (ожидания, простой сервисов) → run.json
+METRICS = {}
+# Хронометраж запуска: (name, cat, start, end, thread) → run.json, trace.json
+SPANS = []
+RUN_T0 = time.monotonic()
+# Настройки запуска (сжатие, исключения, метка) → run.json, history.db
+SETTINGS = {}
+# Каталог textfile-коллектора node_exporter (Debian/Ubuntu)
+PROM_DIR = "/var/lib/prometheus/node-exporter"
+HISTORY_DB = STATE_DIR / "history.db"
+COMPRESSION = "zstd,6"
+# --compression auto: кандидаты, откуда брать образец, кэш выбора
+COMPRESSION_CANDIDATES = [
+    "lz4", "zstd,1", "zstd,3", "zstd,6", "zstd,10", "auto,zstd,6"
+]
+COMPRESSION_SAMPLE_ROOTS = ["/home", "/srv", "/var/lib", "/opt", "/etc", "/usr"]
+COMPRESSION_CACHE = STATE_DIR / "compression.json"
+# FIFO для потоковых дампов (--sql-stream); /run не попадает в бэкап
+SQL_STREAM_DIR = Path("/run/backup.py-sql")
+# Дампы по отдельным базам (--sql-jobs); каталог входит в архив "/"
+SQL_DIR = Path("/var/backups/backup.py-sql")
+MYSQL_SKIP_DBS = {"information_schema", "performance_schema", "sys"}
+# Инкрементальный уровень (--sql-full-every): время полного дампа, binlog
+SQL_TIER_STATE = STATE_DIR / "sql-tier.json"
+# Куда archive_command PostgreSQL складывает WAL, например:
+#   archive_command = 'cp %p /var/lib/postgresql/wal-archive/%f'
+PG_WAL_DIR = Path("/var/lib/postgresql/wal-archive")
+# Точка монтирования LVM-снимка (--snapshot lvm); /mnt исключён из бэкапа
+SNAP_MOUNT = Path("/mnt/backup.py-snap")
+LOCAL_FS = {"ext2", "ext3", "ext4", "xfs", "btrfs", "zfs", "f2fs", "vfat"}
+DOCKER_SOCK = "/var/run/docker.sock"
+# Образы баз данных, которые дампятся через docker exec (--docker dbs)
+DOCKER_DB_IMAGES = {
+    "mysql": {"mysql", "mariadb", "percona", "percona-server"},
+    "postgres": {"postgres", "postgis", "timescaledb"},
+}
+DOCKER_DUMP_SCRIPTS = {
+    "mysql": (
+        'pw="${MARIADB_ROOT_PASSWORD:-$MYSQL_ROOT_PASSWORD}"; '
+        'exec $(command -v mariadb-dump || command -v mysqldump) -uroot '
+        '${pw:+-p"$pw"} --all-databases --single-transaction'
+    ),
+    "postgres": 'exec pg_dumpall -U "${POSTGRES_USER:-postgres}"',
+}
+DOCKER_RESTORE_SCRIPTS = {
+    "mysql": (
+        'pw="${MARIADB_ROOT_PASSWORD:-$MYSQL_ROOT_PASSWORD}"; '
+        'exec $(command -v mariadb || command -v mysql) -uroot ${pw:+-p"$pw"}'
+    ),
+    "postgres": 'exec psql -q -U "${POSTGRES_USER:-postgres}" -d postgres',
+}
+# Согласованные снимки SQLite/Redis (--store); каталог входит в архив "/"
+SNAPSHOT_DIR = Path("/var/backups/backup.py-snap")
+SQLITE_STEP_PAGES = 1024
+SQLITE_STEP_SLEEP = 0.01
+BINLOG_POS_RE = re.compile(
+    rb"(?:MASTER|SOURCE)_LOG_FILE='([^']+)', *(?:MASTER|SOURCE)_LOG_POS=(\d+)"
+)
+# Разметка вывода mysqldump для --sql-tables
+MYSQL_TABLE_RE = re.compile(rb"^-- Table structure for table `(.+)`$")
+MYSQL_TAIL_MARKS = (
+    b"-- Temporary view structure", b"-- Final view structure",
+    b"-- Dumping events", b"-- Dumping routines",
+    b"/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */"
+)
+MYSQL_CREATE_RE = re.compile(rb"^CREATE TABLE `(.+)` \($")
+MYSQL_SECONDARY_KEYS = (
+    b"KEY ", b"UNIQUE KEY ", b"FULLTEXT KEY ", b"SPATIAL KEY "
+)
+# (ident, имя файла, колонки PK) обычных таблиц базы для --sql-tables
+PG_TABLES_SQL = """
+SELECT format('%I.%I', n.nspname, c.relname), n.nspname || '.' || c.relname,
+  coalesce((
+    SELECT string_agg(format('%I', a.attname), ', '
+      ORDER BY array_position(i.indkey::int2[], a.attnum))
+    FROM pg_index i
+    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+    WHERE i.indrelid = c.oid AND i.indisprimary
+  ), '')
+FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind = 'r' AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+  AND n.nspname NOT LIKE 'pg\\_%'
+ORDER BY 2
+"""
 
 
 def setup_logging(log_file):
@@ -66,14 +166,243 @@ def log(msg):
     logging.info(msg)
 
 
+@contextlib.contextmanager
+def span(name, cat="phase"):
+    """Интервал времени в SPANS (фаза, команда, задача пула)."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        SPANS.append((name, cat, start, time.monotonic(), threading.get_ident()))
+
+
+def timed(fn):
+    """Декоратор: каждый вызов fn — фаза с её именем."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with span(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def cmd_name(cmd):
+    return (cmd if isinstance(cmd, str) else shlex.join(map(str, cmd)))[:120]
+
+
 def run(cmd, **kwargs):
-    return subprocess.run(cmd, **kwargs)
+    with span(cmd_name(cmd), "cmd"):
+        return subprocess.run(cmd, **kwargs)
+
+
+def write_run_summary(mode, status):
+    """Итог запуска: run.json (фазы, метрики) и trace.json в формате
+    Chrome trace events (chrome://tracing, Perfetto)."""
+    end = time.monotonic()
+    phases = {}
+    for name, cat, a, b, _ in SPANS:
+        if cat == "phase":
+            phases[name] = round(phases.get(name, 0) + b - a, 3)
+    summary = {
+        "mode": mode,
+        "status": status,
+        "started": round(time.time() - (end - RUN_T0), 3),
+        "duration": round(end - RUN_T0, 3),
+        "phases": dict(sorted(phases.items(), key=lambda x: -x[1])),
+        "commands": [
+            {"cmd": name, "seconds": round(b - a, 3)}
+            for name, cat, a, b, _ in SPANS if cat == "cmd"
+        ],
+        "settings": SETTINGS,
+        "metrics": METRICS,
+    }
+    try:
+        save_json(STATE_DIR / "run.json", summary)
+        save_json(STATE_DIR / "trace.json", {"traceEvents": [
+            {
+                "name": name, "cat": cat, "ph": "X", "pid": os.getpid(),
+                "tid": tid, "ts": int((a - RUN_T0) * 1e6),
+                "dur": int((b - a) * 1e6)
+            }
+            for name, cat, a, b, tid in SPANS
+        ]})
+    except OSError as e:
+        log(f"⚠️ Run summary not written: {e}")
+    top = list(summary["phases"].items())[:5]
+    if not top:
+        return summary
+    log("⏱️ " + ", ".join(f"{n} {sec:.1f}s" for n, sec in top))
+    return summary
+
+
+def write_prom(summary, prom_dir=PROM_DIR):
+    """Метрики запуска для node_exporter: <prom_dir>/backup_py_<mode>.prom,
+    запись через временный файл и rename. Время последнего успеха хранится
+    в STATE_DIR/last-success.json и переживает неудачные запуски."""
+    if not prom_dir or not Path(prom_dir).is_dir():
+        return
+    mode, m = summary["mode"], summary["metrics"]
+    finished = summary["started"] + summary["duration"]
+    success = load_json(STATE_DIR / "last-success.json", {})
+    if summary["status"] == 0:
+        success[mode] = finished
+        save_json(STATE_DIR / "last-success.json", success)
+    if mode == "backup":
+        sizes = {k: m.get(f"archive_{k}_size") for k in (
+            "original", "compressed", "deduplicated"
+        )}
+        files, seconds = m.get("archive_nfiles"), m.get("archive_duration")
+    else:
+        sizes = {"original": m.get("extract_total")}
+        files, seconds = None, summary["phases"].get("borg_extract")
+    metrics = [
+        ("run_duration_seconds", "Wall time of the run", [
+            ({}, summary["duration"])
+        ]),
+        ("phase_duration_seconds", "Wall time per phase", [
+            ({"phase": name}, sec) for name, sec in summary["phases"].items()
+        ]),
+        ("bytes", "Archive bytes by kind (borg stats)", [
+            ({"kind": k}, v) for k, v in sizes.items() if v is not None
+        ]),
+        ("files", "Files in the archive", [({}, files)]),
+        ("throughput_bytes_per_second", "Original bytes per second", [
+            ({}, sizes["original"] / seconds)
+        ] if sizes["original"] and seconds else []),
+        ("service_downtime_seconds", "Docker downtime during the run", [
+            ({}, m.get("docker_downtime_seconds"))
+        ]),
+        ("exit_status", "Exit status of the last run (0 = success)", [
+            ({}, summary["status"])
+        ]),
+        ("last_run_timestamp_seconds", "End of the last run", [
+            ({}, finished)
+        ]),
+        ("last_success_timestamp_seconds", "End of the last successful run", [
+            ({}, success.get(mode))
+        ]),
+    ]
+    out = []
+    for name, help_text, samples in metrics:
+        samples = [(labels, v) for labels, v in samples if v is not None]
+        if not samples:
+            continue
+        out += [
+            f"# HELP backup_py_{name} {help_text}.",
+            f"# TYPE backup_py_{name} gauge",
+        ]
+        for labels, value in samples:
+            labels = ",".join(
+                f'{k}="{v}"' for k, v in {"mode": mode, **labels}.items()
+            )
+            out.append(f"backup_py_{name}{{{labels}}} {value}")
+    path = Path(prom_dir) / f"backup_py_{mode}.prom"
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_text("\n".join(out) + "\n")
+    tmp.chmod(0o644)
+    tmp.replace(path)
+
+
+def history_db():
+    db = sqlite3.connect(HISTORY_DB)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY, started REAL, mode TEXT, status INTEGER,
+            duration REAL, archive TEXT, tag TEXT, compression TEXT,
+            excludes TEXT, original INTEGER, compressed INTEGER,
+            deduplicated INTEGER, nfiles INTEGER, create_seconds REAL,
+            metrics TEXT
+        );
+        CREATE TABLE IF NOT EXISTS phases (
+            run_id INTEGER REFERENCES runs(id), name TEXT, seconds REAL
+        );
+        CREATE INDEX IF NOT EXISTS runs_started ON runs(mode, started);
+    """)
+    return db
+
+
+def record_run(summary):
+    """Запуск в STATE_DIR/history.db: итог, фазы, настройки, статистика."""
+    m, st = summary["metrics"], summary["settings"]
+    with contextlib.closing(history_db()) as db, db:
+        cur = db.execute(
+            "INSERT INTO runs (started, mode, status, duration, archive, tag,"
+            " compression, excludes, original, compressed, deduplicated,"
+            " nfiles, create_seconds, metrics)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                summary["started"], summary["mode"], summary["status"],
+                summary["duration"], st.get("archive"), st.get("tag"),
+                st.get("compression"), json.dumps(st.get("excludes")),
+                m.get("archive_original_size"), m.get("archive_compressed_size"),
+                m.get("archive_deduplicated_size"), m.get("archive_nfiles"),
+                m.get("archive_duration"), json.dumps(m),
+            )
+        )
+        db.executemany(
+            "INSERT INTO phases VALUES (?, ?, ?)",
+            [(cur.lastrowid, n, sec) for n, sec in summary["phases"].items()]
+        )
+
+
+def report(last=20):
+    """Тренды по history.db: MB/s, дедупликация, прирост в день, фазы."""
+    if not HISTORY_DB.exists():
+        print("No history")
+        return
+    with contextlib.closing(history_db()) as db:
+        runs = db.execute(
+            "SELECT id, started, status, duration, original, deduplicated,"
+            " create_seconds, tag FROM runs WHERE mode = 'backup'"
+            " ORDER BY started DESC LIMIT ?", (last,)
+        ).fetchall()[::-1]
+        if not runs:
+            print("No backups in history")
+            return
+        growth = db.execute(
+            "SELECT date(started, 'unixepoch', 'localtime') AS day,"
+            " sum(deduplicated) FROM runs WHERE mode = 'backup' AND status = 0"
+            " GROUP BY day ORDER BY day DESC LIMIT 30"
+        ).fetchall()
+        ids = [r[0] for r in runs]
+        phases = db.execute(
+            "SELECT name, avg(seconds), max(seconds), count(*) FROM phases"
+            f" WHERE run_id IN ({','.join('?' * len(ids))})"
+            " GROUP BY name ORDER BY avg(seconds) DESC LIMIT 10", ids
+        ).fetchall()
+        latest = dict(db.execute(
+            "SELECT name, seconds FROM phases WHERE run_id = ?", ids[-1:]
+        ).fetchall())
+    print(f"\n📈 Last {len(runs)} backups")
+    print("─" * 78)
+    print(f"{'started':<17} {'rc':>3} {'time':>8} {'MB/s':>8} "
+          f"{'dedup':>7} {'new':>10}  tag")
+    for _, started, status, duration, orig, dedup, secs, tag in runs:
+        mbs = f"{orig / secs / 1e6:.1f}" if orig and secs else "-"
+        ratio = f"{orig / dedup:.1f}x" if orig and dedup else "-"
+        print(
+            f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(started)):<17} "
+            f"{status:>3} {fmt_duration(duration):>8} {mbs:>8} {ratio:>7} "
+            f"{fmt_size(dedup) if dedup is not None else '-':>10}  {tag or ''}"
+        )
+    if growth:
+        per_day = sum(b or 0 for _, b in growth) / len(growth)
+        print(f"\n📦 Growth: {fmt_size(per_day)}/day "
+              f"(avg over {len(growth)} days with backups)")
+    if phases:
+        print("\n🐢 Slowest phases (avg / max / last)")
+        for name, avg, top, n in phases:
+            last_sec = latest.get(name)
+            print(
+                f"  {name:<28} {avg:8.1f}s {top:8.1f}s "
+                f"{'-' if last_sec is None else f'{last_sec:.1f}s':>9}  ({n} runs)"
+            )
 
 
 def have_cmd(cmd):
     return which(cmd) is not None
 
 
+@timed
 def smart_install():
     log("🔧 Dependencies...")
     to_install = [
@@ -99,44 +428,1139 @@ def docker_active():
     ).returncode == 0
 
 
-def docker_stop():
+def wait_until(check, timeout):
+    """Опрашивает check() с нарастающим интервалом (0.1 → 1 с) до успеха
+    или таймаута. Возвращает (успех, секунды ожидания)."""
+    t0 = time.monotonic()
+    interval = 0.1
+    while not check():
+        waited = time.monotonic() - t0
+        if waited >= timeout:
+            return False, waited
+        time.sleep(min(interval, timeout - waited))
+        interval = min(interval * 2, 1.0)
+    return True, time.monotonic() - t0
+
+
+def docker_health_pending():
+    """Контейнеры, чей healthcheck ещё в состоянии starting."""
+    return [
+        c["Names"][0].lstrip("/")
+        for c in docker_api("GET", "/containers/json") or []
+        if "(health: starting)" in c.get("Status", "")
+    ]
+
+
+@timed
+def docker_stop(timeout=120):
     log("🐳 Docker stop...")
+    t0 = time.monotonic()
+    METRICS["docker_down_since"] = time.time()
     run(["sudo", "systemctl", "stop", "docker"], check=False)
-    time.sleep(2)
+    ok, _ = wait_until(lambda: not docker_active(), timeout)
+    METRICS["docker_stop_wait_seconds"] = round(time.monotonic() - t0, 3)
+    if not ok:
+        log(f"⚠️ Docker still active after {timeout}s")
 
 
-def docker_start():
+@timed
+def docker_start(timeout=120):
+    """Запуск и ожидание готовности: unit active, /_ping API, healthcheck
+    контейнеров. Каждое ожидание пишется в METRICS."""
     log("🐳 Docker start...")
+    t0 = time.monotonic()
     run(["sudo", "systemctl", "start", "docker"], check=False)
-    time.sleep(3)
+    checks = [
+        ("unit", docker_active),
+        ("ping", lambda: docker_api("GET", "/_ping", timeout=2) is not None),
+        ("health", lambda: not docker_health_pending()),
+    ]
+    for name, check in checks:
+        left = timeout - (time.monotonic() - t0)
+        ok, waited = wait_until(check, max(left, 0))
+        METRICS[f"docker_{name}_wait_seconds"] = round(waited, 3)
+        if not ok:
+            log(f"⚠️ Docker {name} not ready after {timeout}s")
+            break
+    METRICS["docker_start_wait_seconds"] = round(time.monotonic() - t0, 3)
+    since = METRICS.pop("docker_down_since", None)
+    if since:
+        METRICS["docker_downtime_seconds"] = round(time.time() - since, 3)
+    log(f"🐳 Docker ready in {METRICS['docker_start_wait_seconds']}s")
+
+
+class DockerConnection(http.client.HTTPConnection):
+    """HTTP к Docker Engine API через unix-сокет."""
+
+    def __init__(self, path=DOCKER_SOCK, timeout=10):
+        super().__init__("localhost", timeout=timeout)
+        self.sock_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.sock_path)
+
+
+def docker_api(method, path, timeout=10):
+    """JSON-ответ Docker API (None, если демон недоступен или ошибка)."""
+    conn = DockerConnection(timeout=timeout)
+    try:
+        conn.request(method, path)
+        r = conn.getresponse()
+        body = r.read()
+    except OSError:
+        return None
+    finally:
+        conn.close()
+    if r.status >= 300:
+        return None
+    return json.loads(body) if body.strip().startswith((b"{", b"[")) else {}
+
+
+def docker_db_containers():
+    """[(имя, движок)] запущенных контейнеров MySQL/MariaDB/PostgreSQL."""
+    found = []
+    for c in docker_api("GET", "/containers/json") or []:
+        image = c.get("Image", "").rsplit("/", 1)[-1].split(":")[0].split("@")[0]
+        engine = next(
+            (e for e, images in DOCKER_DB_IMAGES.items() if image in images), None
+        )
+        if engine:
+            found.append((c["Names"][0].lstrip("/"), engine))
+    return sorted(found)
+
+
+def docker_dump_commands():
+    """(label, file name, shell command) — дампы баз внутри контейнеров
+    через docker exec, демон и контейнеры продолжают работать."""
+    cmds = []
+    for name, engine in docker_db_containers():
+        script = DOCKER_DUMP_SCRIPTS[engine]
+        cmds.append((
+            f"Docker {name}", f"{name}.sql",
+            f"docker exec {shlex.quote(name)} sh -c {shlex.quote(script)}"
+        ))
+    return cmds
+
+
+@timed
+def docker_dump(env, archive):
+    """Дампы баз из контейнеров → архив <archive>.docker."""
+    dumps = docker_dump_commands()
+    if not dumps:
+        return None
+    return stream_to_archive(
+        env, companion(archive, "docker"), dumps, title="DOCKER SQL"
+    )
 
 
-def sql_dump():
-    dumps = []
-    if have_cmd("mysqldump"):
-        f = "/tmp/mysql_dump.sql"
-        log(f"🗄️ MySQL → {f}")
-        run(
-            f"sudo mysqldump --all-databases --single-transaction > {shlex.quote(f)}",
-            shell=True,
-            check=False
+@timed
+def docker_restore_dumps(env, name):
+    """<archive>.docker: каждый дамп → docker exec -i в одноимённый
+    запущенный контейнер."""
+    running = dict(docker_db_containers())
+    for path in archive_paths(env, name):
+        container = path[:-len(".sql")]
+        engine = running.get(container)
+        if not engine:
+            log(f"⚠️ {container} is not running, skip {path}")
+            continue
+        log(f"🐳 Restore ::{name}/{path} → {container}")
+        extract = subprocess.Popen(
+            ["borg", "extract", "--stdout", f"::{name}", path],
+            env=env,
+            stdout=subprocess.PIPE
         )
-        if Path(f).exists():
-            dumps.append(f)
-    if have_cmd("pg_dumpall"):
-        f = "/tmp/postgres_dump.sql"
-        log(f"🗄️ PG → {f}")
-        run(
-            f"sudo -u postgres pg_dumpall > {shlex.quote(f)}",
-            shell=True,
-            check=False
+        load = subprocess.Popen(
+            ["docker", "exec", "-i", container, "sh", "-c",
+             DOCKER_RESTORE_SCRIPTS[engine]],
+            stdin=extract.stdout
+        )
+        extract.stdout.close()
+        if load.wait() or extract.wait():
+            log(f"❌ Restore {path} → {container}")
+
+
+def excluded(path, excludes):
+    """Попадает ли path под шаблоны --exclude (fm-стиль borg)."""
+    return any(
+        fnmatch.fnmatch(path, ex) or fnmatch.fnmatch(path + "/", ex)
+        for ex in excludes
+    )
+
+
+def docker_stateful(excludes):
+    """Контейнеры, пишущие в тома/bind-монтирования внутри набора бэкапа:
+    {name: {"id", "mounts", "deps"}}. Остальные (stateless) не трогаем."""
+    running = docker_api("GET", "/containers/json") or []
+    services = {}
+    for c in running:
+        labels = c.get("Labels") or {}
+        key = (labels.get("com.docker.compose.project"),
+               labels.get("com.docker.compose.service"))
+        services.setdefault(key, []).append(c["Names"][0].lstrip("/"))
+    found = {}
+    for c in running:
+        info = docker_api("GET", f"/containers/{c['Id']}/json") or {}
+        mounts = [
+            m["Source"] for m in info.get("Mounts", [])
+            if m.get("RW") and m.get("Type") in ("volume", "bind")
+            and m.get("Source") and not excluded(m["Source"], excludes)
+        ]
+        if not mounts:
+            continue
+        labels = c.get("Labels") or {}
+        project = labels.get("com.docker.compose.project")
+        deps = set()
+        for dep in filter(None, labels.get(
+            "com.docker.compose.depends_on", ""
+        ).split(",")):
+            deps.update(services.get((project, dep.split(":")[0]), []))
+        for link in (info.get("HostConfig") or {}).get("Links") or []:
+            deps.add(link.split(":")[0].lstrip("/"))
+        found[c["Names"][0].lstrip("/")] = {
+            "id": c["Id"], "mounts": mounts, "deps": deps
+        }
+    return found
+
+
+def start_levels(containers):
+    """Уровни запуска: сначала зависимости, потом зависящие от них.
+    Остановка идёт в обратном порядке."""
+    left = dict(containers)
+    levels = []
+    while left:
+        ready = sorted(
+            n for n, c in left.items() if not (c["deps"] & left.keys())
+        )
+        if not ready:  # цикл зависимостей — остальные одним уровнем
+            ready = sorted(left)
+        levels.append(ready)
+        for n in ready:
+            del left[n]
+    return levels
+
+
+def docker_quiesce(containers, mode="stop", resume=False):
+    """Параллельно по уровням зависимостей останавливает (pause/stop)
+    или возвращает (unpause/start) контейнеры."""
+    action = {
+        ("pause", False): "pause", ("pause", True): "unpause",
+        ("stop", False): "stop?t=30", ("stop", True): "start",
+    }[(mode, resume)]
+    levels = start_levels(containers)
+    if not resume:
+        levels.reverse()
+
+    def one(name):
+        ok = docker_api(
+            "POST", f"/containers/{containers[name]['id']}/{action}", timeout=60
+        ) is not None
+        log(f"{'🐳' if ok else '❌'} {action.split('?')[0]} {name}")
+
+    for level in levels:
+        with ThreadPoolExecutor(max_workers=len(level)) as pool:
+            list(pool.map(one, level))
+
+
+@timed
+def docker_capture(env, archive, excludes, mode="stop"):
+    """Тома stateful-контейнеров → <archive>.volumes при остановленных
+    только этих контейнерах; они сразу запускаются обратно. Возвращает
+    пути, которые надо исключить из основного архива."""
+    containers = docker_stateful(excludes)
+    if not containers:
+        return []
+    sources = sorted({m for c in containers.values() for m in c["mounts"]})
+    log(f"🐳 Quiesce ({mode}): {', '.join(sorted(containers))}")
+    docker_quiesce(containers, mode)
+    try:
+        stream_command(
+            [
+                "borg", "create", f"::{companion(archive, 'volumes')}",
+                "--stats", "--progress", "--compression", COMPRESSION
+            ] + sum([["--exclude", ex] for ex in excludes], []) + sources,
+            env=env,
+            title="VOLUMES",
+            progress=Progress()
+        )
+    finally:
+        docker_quiesce(containers, mode, resume=True)
+    return sources
+
+
+def must(cmd, what):
+    """run() с выходом при ошибке (очистка — в finally вызывающего)."""
+    r = run(cmd, capture_output=True, text=True, check=False)
+    if r.returncode:
+        log(f"❌ {what}: {r.stderr.strip()}")
+        sys.exit(1)
+    return r.stdout
+
+
+@contextlib.contextmanager
+def fs_snapshot(kind, mountpoint="/", size="10%ORIGIN"):
+    """Снимок ФС, смонтированной в mountpoint (lvm / btrfs / zfs).
+    yield — каталог со снимком; снимок удаляется и при ошибке."""
+    source, fstype = must(
+        ["findmnt", "-no", "SOURCE,FSTYPE", mountpoint], "findmnt"
+    ).split()
+    source = source.split("[")[0]  # btrfs: /dev/sda2[/@]
+    name = "backup.py-snap"
+    if kind == "lvm":
+        vg, lv = must(
+            ["lvs", "--noheadings", "-o", "vg_name,lv_name", source], "lvs"
+        ).split()
+        cleanup = [["umount", str(SNAP_MOUNT)], ["lvremove", "-f", f"{vg}/{name}"]]
+    elif kind == "btrfs":
+        path = Path(mountpoint) / f".{name}"
+        cleanup = [["btrfs", "subvolume", "delete", str(path)]]
+    else:
+        snap = f"{source}@{name}"
+        path = Path(mountpoint) / ".zfs" / "snapshot" / name
+        cleanup = [["zfs", "destroy", snap]]
+    for cmd in cleanup:  # хвосты прошлого неудачного запуска
+        run(cmd, capture_output=True, check=False)
+    log(f"📸 {kind} snapshot of {mountpoint} ({source})")
+    try:
+        if kind == "lvm":
+            must([
+                "lvcreate", "-s", "-n", name,
+                "-l" if "%" in size else "-L", size, f"{vg}/{lv}"
+            ], "lvcreate")
+            SNAP_MOUNT.mkdir(parents=True, exist_ok=True)
+            must([
+                "mount", "-o", "ro,nouuid" if fstype == "xfs" else "ro",
+                f"/dev/{vg}/{name}", str(SNAP_MOUNT)
+            ], "mount snapshot")
+            path = SNAP_MOUNT
+        elif kind == "btrfs":
+            must(
+                ["btrfs", "subvolume", "snapshot", "-r", mountpoint, str(path)],
+                "btrfs snapshot"
+            )
+        else:
+            must(["zfs", "snapshot", snap], "zfs snapshot")
+        yield path
+    finally:
+        for cmd in cleanup:
+            run(cmd, capture_output=True, check=False)
+        log("📸 Snapshot removed")
+
+
+def other_mounts(root, excludes):
+    """Прочие локальные ФС внутри набора бэкапа: в снимок root они
+    не входят и читаются вживую."""
+    mounts = set()
+    with open("/proc/self/mounts") as f:
+        for line in f:
+            _, mnt, fstype = line.split()[:3]
+            mnt = mnt.replace("\\040", " ")
+            if fstype in LOCAL_FS and mnt != root and not excluded(mnt, excludes):
+                mounts.add(mnt)
+    return sorted(mounts)
+
+
+def mount_of(path):
+    """Точка монтирования, на которой лежит path (самый длинный префикс)."""
+    path = os.path.realpath(path)
+    best = "/"
+    with open("/proc/self/mounts") as f:
+        for line in f:
+            mnt = line.split()[1].replace("\\040", " ")
+            if (path == mnt or path.startswith(mnt.rstrip("/") + "/")) \
+                    and len(mnt) > len(best):
+                best = mnt
+    return best
+
+
+@contextlib.contextmanager
+def fs_frozen(mounts, timeout=10):
+    """fsfreeze -f на время критической секции. Разморозка гарантирована:
+    в finally и сторожевым таймером через timeout секунд, даже если
+    секция повисла на записи в замороженную ФС."""
+    frozen = []
+    lock = threading.Lock()
+
+    def thaw():
+        with lock:
+            while frozen:
+                run(["fsfreeze", "-u", frozen.pop()], capture_output=True,
+                    stdin=subprocess.DEVNULL, check=False)
+
+    def expire():
+        thaw()  # сначала разморозка: лог может лежать на замороженной ФС
+        log(f"⚠️ Freeze timeout ({timeout}s), thawed")
+
+    run(["sync"], check=False)  # грязные страницы — до заморозки, не во время
+    watchdog = threading.Timer(timeout, expire)
+    watchdog.daemon = True
+    t0 = time.monotonic()
+    try:
+        watchdog.start()
+        for m in mounts:
+            r = run(["fsfreeze", "-f", m], capture_output=True,
+                    stdin=subprocess.DEVNULL, check=False)
+            if r.returncode == 0:
+                with lock:
+                    frozen.append(m)
+        yield frozen
+    finally:
+        watchdog.cancel()
+        thaw()
+        log(f"🧊 Thawed {', '.join(mounts)} after {time.monotonic() - t0:.2f}s")
+
+
+@timed
+def consistency_point(mounts, hooks, timeout=10):
+    """Точка согласованности без снимков: заморозка, хуки (не должны писать
+    в замороженные ФС), метаданные в память; возвращает метаданные.
+    Вывод хуков перехватывается: терминал или лог cron может лежать
+    на замороженной ФС, и запись в него повесила бы хук до таймера."""
+    meta = {"time": time.time(), "mounts": mounts, "hooks": []}
+    deadline = time.monotonic() + timeout
+    with fs_frozen(mounts, timeout) as frozen:
+        meta["frozen"] = list(frozen)
+        for hook in hooks:
+            left = deadline - time.monotonic()
+            try:
+                r = run(hook, shell=True, timeout=max(left, 0.1),
+                        capture_output=True, stdin=subprocess.DEVNULL,
+                        text=True, check=False)
+                rc, err = r.returncode, (r.stderr or "")[-500:]
+            except subprocess.TimeoutExpired:
+                rc, err = "timeout", ""
+            meta["hooks"].append({"cmd": hook, "rc": rc, "stderr": err})
+        meta["fs"] = {}
+        for m in mounts:
+            st = os.statvfs(m)
+            meta["fs"][m] = {
+                "blocks": st.f_blocks, "free": st.f_bfree,
+                "files": st.f_files, "ffree": st.f_ffree
+            }
+        meta["stall"] = round(time.time() - meta["time"], 3)
+    return meta
+
+
+def sql_dump_commands(pg=True, binlog_pos=False, mysql=True):
+    """(label, имя файла, shell-команда) для каждого дампа, доступного хосту.
+    binlog_pos — записать в дамп позицию binlog для PITR."""
+    cmds = []
+    if mysql and have_cmd("mysqldump"):
+        cmd = "sudo mysqldump --all-databases --single-transaction"
+        if binlog_pos:
+            # --source-data появился в MySQL 8.0.26; MariaDB и старые MySQL
+            # знают только --master-data
+            source = "--source-data" in run(
+                ["mysqldump", "--help"], capture_output=True, text=True,
+                check=False
+            ).stdout
+            cmd += " --source-data=2" if source else " --master-data=2"
+        cmds.append(("MySQL", "mysql_dump.sql", cmd))
+    if pg and have_cmd("pg_dumpall"):
+        cmds.append(("PG", "postgres_dump.sql", "sudo -u postgres pg_dumpall"))
+    return cmds
+
+
+def sql_query(engine, query, db=None):
+    """Строки результата запроса к локальному MySQL/PG ([] при ошибке)."""
+    if engine == "mysql":
+        cmd = ["sudo", "mysql", "-N", "-B", "-e", query]
+    else:
+        cmd = ["sudo", "-u", "postgres", "psql", "-At", "-F", "\t", "-c", query]
+    if db:
+        cmd += [db]
+    r = run(cmd, capture_output=True, text=True, check=False)
+    if r.returncode:
+        return []
+    return [x.split("\t") for x in r.stdout.splitlines() if x]
+
+
+def mysql_dump_tables(db):
+    """Один согласованный mysqldump базы, разрезанный по таблицам:
+    <db>/_head.sql, <db>/tables/<table>.sql, <db>/_tail.sql (views,
+    routines, events). Таблицы — в своём каталоге, имена вроде _head или
+    _prisma_migrations не пересекаются со служебными файлами; "/" в имени
+    файла заменяется, как у PG, настоящее имя — в <db>/tables.tsv.
+    Строки по первичному ключу, без даты дампа — неизменные таблицы
+    дают побайтно одинаковые файлы и полностью дедуплицируются."""
+    d = SQL_DIR / "mysql" / db
+    (d / "tables").mkdir(parents=True)
+    manifest = []
+    proc = subprocess.Popen(
+        [
+            "sudo", "mysqldump", "--single-transaction", "--order-by-primary",
+            "--skip-dump-date", "--routines", "--events", "--triggers",
+            "--databases", db
+        ],
+        stdout=subprocess.PIPE
+    )
+    tail = open(d / "_tail.sql", "wb")
+    out = open(d / "_head.sql", "wb")
+    try:
+        for line in proc.stdout:
+            m = MYSQL_TABLE_RE.match(line)
+            if m:
+                if out is not tail:
+                    out.close()
+                name = m.group(1).decode()
+                fname = name.replace("/", "_") + ".sql"
+                manifest.append(f"{fname}\t{name}\n")
+                out = open(d / "tables" / fname, "wb")
+            elif line.startswith(MYSQL_TAIL_MARKS) and out is not tail:
+                out.close()
+                out = tail
+            out.write(line)
+    finally:
+        out.close()
+        tail.close()
+    (d / "tables.tsv").write_text("".join(manifest))
+    return proc.wait()
+
+
+def pg_dump_tables(db):
+    """Схема (pre-data / post-data) и данные каждой таблицы в отдельном файле
+    <db>/<schema.table>.copy, строки по первичному ключу. Все \\copy идут
+    в одной REPEATABLE READ транзакции; её снимок экспортируется
+    (pg_export_snapshot) и передаётся обоим pg_dump через --snapshot,
+    так что схема и данные — из одного снимка."""
+    d = SQL_DIR / "postgres" / db
+    d.mkdir()
+    shutil.chown(d, "postgres")
+    tables = sql_query("postgres", PG_TABLES_SQL, db)
+    script = []
+    manifest = []
+    for ident, name, pk in tables:
+        fname = name.replace("/", "_") + ".copy"
+        order = f" ORDER BY {pk}" if pk else ""
+        script.append(
+            f"\\copy (SELECT * FROM {ident}{order}) TO '{d / fname}'"
+        )
+        manifest.append(f"{fname}\t{ident}\n")
+    script.append("COMMIT;")
+    (d / "tables.tsv").write_text("".join(manifest))
+    # Транзакция держится открытой, пока pg_dump читают её снимок
+    proc = subprocess.Popen(
+        [
+            "sudo", "-u", "postgres", "psql", "-X", "-q", "-At",
+            "-v", "ON_ERROR_STOP=1", db
+        ],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+    )
+    proc.stdin.write(
+        "BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY;\n"
+        "SELECT pg_export_snapshot();\n"
+    )
+    proc.stdin.flush()
+    snapshot = proc.stdout.readline().strip()
+    if not snapshot:
+        proc.communicate("")
+        return proc.returncode or 1
+    rc = 0
+    for section in ("pre-data", "post-data"):
+        rc |= run([
+            "sudo", "-u", "postgres", "pg_dump", "--schema-only",
+            f"--snapshot={snapshot}", f"--section={section}",
+            "-f", str(d / f"{section}.sql"), db
+        ], check=False).returncode
+    proc.communicate("\n".join(script) + "\n")
+    return rc | proc.returncode
+
+
+def sql_dump_tasks(jobs, tables=False, pg=True, mysql=True):
+    """(size, label, task) для каждой базы MySQL/PG → SQL_DIR.
+    task — shell-команда или функция, возвращающая код выхода."""
+    tasks = []
+    if mysql and have_cmd("mysqldump"):
+        d = SQL_DIR / "mysql"
+        d.mkdir(parents=True)
+        sizes = dict(sql_query(
+            "mysql",
+            "SELECT table_schema, SUM(data_length + index_length) "
+            "FROM information_schema.tables GROUP BY table_schema"
+        ))
+        for (db,) in sql_query("mysql", "SHOW DATABASES"):
+            if db in MYSQL_SKIP_DBS:
+                continue
+            f = d / f"{db}.sql"
+            tasks.append((
+                int(sizes.get(db) or 0), f"MySQL {db}",
+                partial(mysql_dump_tables, db) if tables else
+                "sudo mysqldump --single-transaction --routines --events "
+                f"--triggers --databases {shlex.quote(db)} > {shlex.quote(str(f))}"
+            ))
+    if pg and have_cmd("pg_dump"):
+        d = SQL_DIR / "postgres"
+        d.mkdir(parents=True)
+        shutil.chown(d, "postgres")  # pg_dump -Fd пишет от имени postgres
+        tasks.append((
+            0, "PG globals",
+            f"sudo -u postgres pg_dumpall --globals-only > {d / 'globals.sql'}"
+        ))
+        dbs = sql_query(
+            "postgres",
+            "SELECT datname, pg_database_size(datname) FROM pg_database "
+            "WHERE datallowconn AND NOT datistemplate"
+        )
+        # Бюджет jobs делится между базами: пул сам по себе jobs-широкий,
+        # и -j jobs у каждой дало бы до jobs² соединений
+        pg_jobs = max(1, jobs // max(len(dbs), 1))
+        for db, size in dbs:
+            tasks.append((
+                int(size), f"PG {db}",
+                partial(pg_dump_tables, db) if tables else
+                f"sudo -u postgres pg_dump -Fd -j {pg_jobs} "
+                f"-f {shlex.quote(str(d / db))} {shlex.quote(db)}"
+            ))
+    # Крупные базы первыми: общий хвост определяет самая большая база
+    return sorted(tasks, key=lambda t: -t[0])
+
+
+def run_pool(tasks, jobs):
+    """Запускает (label, command | callable) в пуле из jobs потоков.
+    Возвращает метки упавших задач."""
+    done = []
+    lock = threading.Lock()
+
+    def one(task):
+        label, cmd = task
+        log(f"🗄️ {label}...")
+        t0 = time.monotonic()
+        with span(label, "task"):
+            if callable(cmd):
+                rc = cmd()
+            else:
+                rc = run(cmd, shell=isinstance(cmd, str), check=False).returncode
+        with lock:
+            done.append(label)
+            n = len(done)
+        log(
+            f"{'❌' if rc else '✅'} [{n}/{len(tasks)}] {label} "
+            f"({time.monotonic() - t0:.0f}s)"
         )
+        return label if rc else None
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return [label for label in pool.map(one, tasks) if label]
+
+
+@timed
+def sql_dump(jobs=0, tables=False, pg=True, mysql=True):
+    if jobs or tables:
+        # Отдельный артефакт на каждую базу, MySQL и PG в одном пуле
+        jobs = max(jobs, 1)
+        shutil.rmtree(SQL_DIR, ignore_errors=True)
+        SQL_DIR.mkdir(mode=0o711, parents=True)
+        tasks = sql_dump_tasks(jobs, tables, pg, mysql)
+        log(f"🗄️ {len(tasks)} dumps → {SQL_DIR} (jobs={jobs})")
+        failed = run_pool([t[1:] for t in tasks], jobs)
+        if failed:
+            log(f"❌ Dump failed: {', '.join(failed)}")
+        return [str(SQL_DIR)]
+    dumps = []
+    for label, name, cmd in sql_dump_commands(pg, mysql=mysql):
+        f = f"/tmp/{name}"
+        log(f"🗄️ {label} → {f}")
+        run(f"{cmd} > {shlex.quote(f)}", shell=True, check=False)
         if Path(f).exists():
             dumps.append(f)
     return dumps
 
 
-def sql_restore():
+@timed
+def remove_dumps(paths):
+    for p in map(Path, paths):
+        if p.is_dir():
+            shutil.rmtree(p, ignore_errors=True)
+        else:
+            p.unlink(missing_ok=True)
+
+
+def stream_to_archive(env, name, dumps, title="SQL"):
+    """Команды (label, file name, shell command) пишут в FIFO, borg читает
+    их (--read-special) в архив name — без промежуточных файлов. Память
+    ограничена буфером pipe, дамп и запись в репозиторий идут одновременно."""
+    SQL_STREAM_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+    procs = []
+    try:
+        for label, fname, cmd in dumps:
+            fifo = SQL_STREAM_DIR / fname
+            fifo.unlink(missing_ok=True)
+            os.mkfifo(fifo, 0o600)
+            log(f"🗄️ {label} ⇢ ::{name}/{fname}")
+            # Оболочка блокируется на open() FIFO, пока borg не начнёт читать
+            procs.append((label, subprocess.Popen(
+                f"{cmd} > {shlex.quote(str(fifo))}",
+                shell=True,
+                start_new_session=True
+            )))
+        stream_command(
+            [
+                "borg", "create", f"::{name}",
+                "--read-special", "--stats", "--progress",
+                "--compression", COMPRESSION
+            ] + [fname for _, fname, _ in dumps],
+            env=env,
+            cwd=str(SQL_STREAM_DIR),
+            title=f"{title} {name}",
+            progress=Progress()
+        )
+        failed = [label for label, proc in procs if proc.wait()]
+    finally:
+        for _, proc in procs:
+            if proc.poll() is None:
+                os.killpg(proc.pid, signal.SIGTERM)
+                proc.wait()
+        for _, fname, _ in dumps:
+            (SQL_STREAM_DIR / fname).unlink(missing_ok=True)
+    if failed:
+        log(f"❌ Dump failed: {', '.join(failed)} (::{name} is incomplete)")
+        sys.exit(1)
+    return name
+
+
+@timed
+def sql_stream(env, archive, pg=True, binlog_pos=False, mysql=True):
+    """Логические дампы → архив <archive>.sql (--sql-stream)."""
+    dumps = sql_dump_commands(pg, binlog_pos, mysql)
+    if not dumps:
+        return None
+    return stream_to_archive(env, companion(archive, "sql"), dumps)
+
+
+@timed
+def pg_physical_backup(env, archive):
+    """pg_basebackup (tar в stdout, WAL внутри) → архив <archive>.pgbase."""
+    if not have_cmd("pg_basebackup"):
+        log("❌ pg_basebackup not found")
+        return None
+    return stream_to_archive(env, companion(archive, "pgbase"), [
+        (
+            "PG datadir", "data_directory",
+            f"sudo -u postgres psql -XAtc {shlex.quote('SHOW data_directory')}"
+        ),
+        (
+            "PG base", "base.tar",
+            "sudo -u postgres pg_basebackup -D - -Ft -X fetch -c fast"
+        )
+    ], title="PG BASE")
+
+
+def pg_service(service, datadir, action):
+    """Остановка/запуск PostgreSQL: unit systemd или pg_ctl, если unit пуст
+    (например, временный локальный кластер)."""
+    if service:
+        cmd = ["sudo", "systemctl", action, service]
+    else:
+        cmd = ["sudo", "-u", "postgres", "pg_ctl", "-D", datadir, "-w", action]
+    return run(cmd, check=False).returncode
+
+
+@timed
+def pg_physical_restore(env, name, service="postgresql", datadir=None,
+                        recover=None):
+    """Кластер из <archive>.pgbase без проигрывания SQL: остановка, старый
+    каталог в сторону, tar из репозитория прямо в data_directory, запуск.
+    recover(datadir) вызывается перед запуском (настройка PITR)."""
+    if not datadir:
+        datadir = run(
+            ["borg", "extract", "--stdout", f"::{name}", "data_directory"],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=False
+        ).stdout.strip()
+    if not datadir:
+        log(f"❌ ::{name}: data_directory unknown, use --pg-datadir")
+        return False
+    data = Path(datadir)
+    old = data.with_name(data.name + ".pre-restore")
+    log(f"🗄️ PG base ::{name} → {data}")
+    # pg_ctl stop у уже остановленного кластера — ошибка, status 3 — норма
+    if pg_service(service, datadir, "stop") and (
+        service or pg_service(service, datadir, "status") != 3
+    ):
+        log(f"❌ PG stop failed, {data} untouched")
+        return False
+    shutil.rmtree(old, ignore_errors=True)
+    if data.exists():
+        data.rename(old)
+    data.mkdir(mode=0o700, parents=True)
+    extract = subprocess.Popen(
+        ["borg", "extract", "--stdout", f"::{name}", "base.tar"],
+        env=env,
+        stdout=subprocess.PIPE
+    )
+    untar = subprocess.Popen(["tar", "-x", "-C", datadir], stdin=extract.stdout)
+    extract.stdout.close()
+    ok = untar.wait() == 0 and extract.wait() == 0
+    if ok and recover:
+        recover(datadir)
+    run(["chown", "-R", "postgres:postgres", datadir], check=False)
+    if ok and pg_service(service, datadir, "start") == 0:
+        shutil.rmtree(old, ignore_errors=True)
+        log("✅ PG cluster restored")
+        return True
+    log(f"❌ PG base restore failed, previous data kept in {old}")
+    return False
+
+
+def mysql_backup_tool():
+    """mariabackup или xtrabackup и соответствующий распаковщик xbstream."""
+    if have_cmd("mariabackup"):
+        return "mariabackup", "mbstream"
+    if have_cmd("xtrabackup"):
+        return "xtrabackup", "xbstream"
+    return None, None
+
+
+@timed
+def mysql_physical_backup(env, archive):
+    """Горячая физическая копия InnoDB (--stream=xbstream) → архив
+    <archive>.mysqlbase; скорость ограничена диском, а не mysqldump."""
+    tool, _ = mysql_backup_tool()
+    if not tool:
+        log("❌ mariabackup/xtrabackup not found")
+        return None
+    return stream_to_archive(env, companion(archive, "mysqlbase"), [
+        (
+            "MySQL datadir", "datadir",
+            f"sudo mysql -N -B -e {shlex.quote('SELECT @@datadir')}"
+        ),
+        (
+            "MySQL base", "backup.xbstream",
+            f"sudo {tool} --backup --stream=xbstream --target-dir=/tmp"
+        )
+    ], title="MySQL BASE")
+
+
+@timed
+def mysql_physical_restore(env, name, service="mysql", datadir=None):
+    """<archive>.mysqlbase: распаковка xbstream во временный каталог,
+    --prepare, остановка сервера, --move-back в пустой datadir, запуск."""
+    tool, unpack = mysql_backup_tool()
+    if not tool:
+        log("❌ mariabackup/xtrabackup not found")
+        return False
+    if not datadir:
+        datadir = run(
+            ["borg", "extract", "--stdout", f"::{name}", "datadir"],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=False
+        ).stdout.strip()
+    if not datadir:
+        log(f"❌ ::{name}: datadir unknown, use --mysql-datadir")
+        return False
+    data = Path(datadir)
+    old = data.with_name(data.name + ".pre-restore")
+    work = Path(tempfile.mkdtemp(prefix="backup.py-mysqlbase-", dir="/var/tmp"))
+    log(f"🗄️ MySQL base ::{name} → {data}")
+    try:
+        extract = subprocess.Popen(
+            ["borg", "extract", "--stdout", f"::{name}", "backup.xbstream"],
+            env=env,
+            stdout=subprocess.PIPE
+        )
+        untar = subprocess.Popen(
+            [unpack, "-x", "-C", str(work)], stdin=extract.stdout
+        )
+        extract.stdout.close()
+        if untar.wait() or extract.wait() or run(
+            [tool, "--prepare", f"--target-dir={work}"], check=False
+        ).returncode:
+            log("❌ MySQL base extract/prepare failed, server untouched")
+            return False
+        if run(["sudo", "systemctl", "stop", service], check=False).returncode:
+            log(f"❌ MySQL stop failed, {data} untouched")
+            return False
+        shutil.rmtree(old, ignore_errors=True)
+        if data.exists():
+            data.rename(old)
+        data.mkdir(mode=0o750, parents=True)
+        ok = run(
+            [tool, "--move-back", f"--target-dir={work}", f"--datadir={data}"],
+            check=False
+        ).returncode == 0
+        run(["chown", "-R", "mysql:mysql", datadir], check=False)
+        started = ok and run(
+            ["sudo", "systemctl", "start", service], check=False
+        ).returncode == 0
+        if started:
+            shutil.rmtree(old, ignore_errors=True)
+            log("✅ MySQL datadir restored")
+            return True
+        log(f"❌ MySQL base restore failed, previous data kept in {old}")
+        return False
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def snapshot_sqlite(target, dest):
+    """SQLite online backup API: страницы копируются пачками с паузой,
+    писатели между шагами не блокируются."""
+    rc = 0
+    for path in sorted(glob.glob(target)) or [target]:
+        out = dest / "sqlite" / path.lstrip("/").replace("/", "%")
+        out.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            src = sqlite3.connect(
+                Path(path).absolute().as_uri() + "?mode=ro", uri=True
+            )
+            dst = sqlite3.connect(out)
+            with dst:
+                src.backup(dst, pages=SQLITE_STEP_PAGES, sleep=SQLITE_STEP_SLEEP)
+            src.close()
+            dst.close()
+            log(f"✅ SQLite {path}")
+        except sqlite3.Error as e:
+            log(f"❌ SQLite {path}: {e}")
+            rc = 1
+    return rc
+
+
+def snapshot_redis(target, dest, timeout=600):
+    """BGSAVE и ожидание нового LASTSAVE; готовый RDB кладётся в dest
+    (жёсткая ссылка, если та же ФС). Пароль — REDISCLI_AUTH."""
+    host, _, port = (target or "127.0.0.1:6379").rpartition(":")
+    cli = ["redis-cli", "-h", host or "127.0.0.1", "-p", port or "6379"]
+
+    def redis(*cmd):
+        r = run(cli + list(cmd), capture_output=True, text=True, check=False)
+        return r.stdout.split() if r.returncode == 0 else []
+
+    before = redis("LASTSAVE")
+    if not before or not redis("BGSAVE"):
+        log(f"❌ Redis {target}: BGSAVE failed")
+        return 1
+    deadline = time.monotonic() + timeout
+    while redis("LASTSAVE") == before:
+        if time.monotonic() > deadline:
+            log(f"❌ Redis {target}: BGSAVE timeout")
+            return 1
+        time.sleep(0.5)
+    out = dest / "redis" / f"{host or '127.0.0.1'}_{port or '6379'}.rdb"
+    try:
+        # CONFIG может быть переименован/запрещён — тогда пусто или ошибка
+        rdb = Path(redis("CONFIG", "GET", "dir")[-1]) / redis(
+            "CONFIG", "GET", "dbfilename"
+        )[-1]
+        out.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(rdb, out)
+        except OSError:
+            shutil.copy2(rdb, out)
+    except (IndexError, OSError) as e:
+        log(f"❌ Redis {target}: RDB not found ({e})")
+        return 1
+    log(f"✅ Redis {target} → {out}")
+    return 0
+
+
+# Снимки встраиваемых хранилищ (--store KIND:TARGET) без остановки сервисов
+SNAPSHOTTERS = {
+    "sqlite": snapshot_sqlite,
+    "redis": snapshot_redis,
+}
+
+
+@timed
+def store_snapshots(specs):
+    """Снимки хранилищ в SNAPSHOT_DIR (входит в архив "/")."""
+    if not specs:
+        return []
+    shutil.rmtree(SNAPSHOT_DIR, ignore_errors=True)
+    SNAPSHOT_DIR.mkdir(mode=0o700, parents=True)
+    for spec in specs:
+        kind, _, target = spec.partition(":")
+        snap = SNAPSHOTTERS.get(kind)
+        if not snap:
+            log(f"❌ Unknown store {kind!r} ({', '.join(SNAPSHOTTERS)})")
+            continue
+        log(f"📸 {kind} {target}")
+        snap(target, SNAPSHOT_DIR)
+    return [str(SNAPSHOT_DIR)]
+
+
+def load_json(path, default):
+    try:
+        return json.loads(Path(path).read_text())
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    tmp = Path(f"{path}.tmp")
+    tmp.write_text(json.dumps(data, indent=2))
+    tmp.replace(path)
+
+
+def sql_full_due(days):
+    """Пора ли делать полный дамп (--sql-full-every DAYS)."""
+    last = load_json(SQL_TIER_STATE, {}).get("last_full", 0)
+    return time.time() - last >= days * 86400
+
+
+@timed
+def sql_increments(env, archive, wal_dir=PG_WAL_DIR, pg_wal=True):
+    """Инкременты с прошлого запуска: закрытые binlog MySQL →
+    <archive>.binlog, WAL из archive_command PostgreSQL → <archive>.wal.
+    Стоимость зависит от объёма записи, а не от размера баз.
+    WAL проигрывается только поверх pg_basebackup: без pg_wal
+    (--pg-physical) он не забирается и не удаляется."""
+    state = load_json(SQL_TIER_STATE, {})
+    flushed = have_cmd("mysql") and run(
+        ["sudo", "mysql", "-e", "FLUSH BINARY LOGS"],
+        capture_output=True,
+        check=False
+    ).returncode == 0
+    base = sql_query("mysql", "SELECT @@log_bin_basename") if flushed else []
+    if base and base[0][0] != "NULL":
+        # Последний файл — активный, его заберём в следующий раз
+        logs = [row[0] for row in sql_query("mysql", "SHOW BINARY LOGS")][:-1]
+        new = [f for f in logs if f > state.get("binlog", "")]
+        if new:
+            stream_command(
+                ["borg", "create", f"::{companion(archive, 'binlog')}",
+                 "--stats", "--progress", "--compression", COMPRESSION] + new,
+                env=env,
+                cwd=str(Path(base[0][0]).parent),
+                title="BINLOG",
+                progress=Progress()
+            )
+            state["binlog"] = new[-1]
+    if wal_dir.is_dir() and have_cmd("psql") and not pg_wal:
+        log(f"⚠️ WAL in {wal_dir} not shipped: PG PITR needs --pg-physical, "
+            "WAL cannot be replayed on a logical dump")
+    elif wal_dir.is_dir() and have_cmd("psql"):
+        seg = sql_query("postgres", "SELECT pg_walfile_name(pg_switch_wal())")
+        # archive_command асинхронный: ждём, пока закрытый сегмент уйдёт
+        deadline = time.monotonic() + 60
+        while seg and time.monotonic() < deadline and not sql_query(
+            "postgres",
+            "SELECT 1 FROM pg_stat_archiver "
+            f"WHERE last_archived_wal >= '{seg[0][0]}'"
+        ):
+            time.sleep(1)
+        wal = sorted(f.name for f in wal_dir.iterdir() if f.is_file())
+        if wal:
+            stream_command(
+                ["borg", "create", f"::{companion(archive, 'wal')}",
+                 "--stats", "--progress", "--compression", COMPRESSION] + wal,
+                env=env,
+                cwd=str(wal_dir),
+                title="WAL",
+                progress=Progress()
+            )
+            for f in wal:
+                (wal_dir / f).unlink()
+    save_json(SQL_TIER_STATE, state)
+
+
+def mysql_restore_position(env, name):
+    """mysql_dump.sql из <archive>.sql → mysql; возвращает позицию binlog
+    (file, pos), записанную mysqldump --source-data=2."""
+    extract = subprocess.Popen(
+        ["borg", "extract", "--stdout", f"::{name}", "mysql_dump.sql"],
+        env=env,
+        stdout=subprocess.PIPE
+    )
+    load = subprocess.Popen(["sudo", "mysql"], stdin=subprocess.PIPE)
+    head, pos = b"", None
+    try:
+        for chunk in iter(lambda: extract.stdout.read(1 << 20), b""):
+            if pos is None and len(head) < 1 << 20:
+                head += chunk
+                m = BINLOG_POS_RE.search(head)
+                if m:
+                    pos = (m.group(1).decode(), m.group(2).decode())
+            load.stdin.write(chunk)
+    finally:
+        load.stdin.close()
+    if load.wait() or extract.wait():
+        log(f"❌ Restore ::{name}/mysql_dump.sql")
+        return None
+    return pos
+
+
+@timed
+def sql_pitr_restore(env, archive, until, pg_service_name="postgresql",
+                     pg_datadir=None, wal_dir=PG_WAL_DIR):
+    """Последний полный дамп до archive + все инкременты после него,
+    проигранные до момента until ("YYYY-MM-DD HH:MM:SS")."""
+    groups = archive_groups(env)
+    names = [g[0] for g in groups]
+    upto = names.index(archive) + 1 if archive in names else len(groups)
+
+    def last_full(kind):
+        for i in range(upto - 1, -1, -1):
+            if kind in groups[i][1]:
+                return i, groups[i][1][kind]
+        return None, None
+
+    def increments(start, kind, dest):
+        for _, extra in groups[start:]:
+            if kind in extra:
+                run(["borg", "extract", f"::{extra[kind]}"],
+                    env=env, cwd=str(dest), check=False)
+
+    i, full_sql = last_full("sql")
+    if full_sql and have_cmd("mysql"):
+        log(f"🗄️ PITR MySQL: ::{full_sql} + binlog → {until}")
+        pos = mysql_restore_position(env, full_sql)
+        if pos and have_cmd("mysqlbinlog"):
+            tmp = Path(tempfile.mkdtemp(prefix="backup.py-binlog-", dir="/var/tmp"))
+            try:
+                increments(i, "binlog", tmp)
+                files = sorted(str(f) for f in tmp.iterdir() if f.name >= pos[0])
+                if files:
+                    r = run(
+                        f"mysqlbinlog --start-position={pos[1]} "
+                        f"--stop-datetime={shlex.quote(until)} "
+                        f"{' '.join(map(shlex.quote, files))} | sudo mysql",
+                        shell=True,
+                        check=False
+                    )
+                    log(f"{'❌' if r.returncode else '✅'} binlog replay "
+                        f"({len(files)} files)")
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+        elif not pos:
+            log("❌ No binlog position in dump, PITR skipped")
+
+    if full_sql and not last_full("pgbase")[1] and (
+        "postgres_dump.sql" in archive_paths(env, full_sql, "postgres_dump.sql")
+    ):
+        # Логический дамп PG: только состояние на момент полного бэкапа
+        log(f"⚠️ PG PITR not available (no --pg-physical base): "
+            f"restoring ::{full_sql}/postgres_dump.sql as of the full dump")
+        sql_restore_stream(env, [(full_sql, "postgres_dump.sql", "psql")])
+
+    i, full_pg = last_full("pgbase")
+    if full_pg:
+        log(f"🗄️ PITR PG: ::{full_pg} + WAL → {until}")
+
+        def recover(datadir):
+            wal_dir.mkdir(parents=True, exist_ok=True)
+            increments(i, "wal", wal_dir)
+            run(["chown", "-R", "postgres:postgres", str(wal_dir)], check=False)
+            with open(Path(datadir) / "postgresql.auto.conf", "a") as f:
+                f.write(
+                    f"restore_command = 'cp {wal_dir}/%f %p'\n"
+                    f"recovery_target_time = '{until}'\n"
+                    "recovery_target_action = 'promote'\n"
+                )
+            (Path(datadir) / "recovery.signal").touch()
+
+        pg_physical_restore(
+            env, full_pg, pg_service_name, pg_datadir, recover=recover
+        )
+
+
+@timed
+def sql_restore(jobs=1):
     for f, cmd in [
         ("/tmp/mysql_dump.sql", "mysql"),
         ("/tmp/postgres_dump.sql", "psql")
@@ -149,8 +1573,217 @@ def sql_restore():
                 shell=True
             )
             p.unlink(missing_ok=True)
+    if SQL_DIR.is_dir():
+        sql_restore_dir(jobs)
+        remove_dumps([SQL_DIR])
+
+
+def mysql_defer_keys(lines, keys, fks):
+    """Фильтр строк дампа таблицы: убирает вторичные индексы и FOREIGN KEY
+    из CREATE TABLE, складывая их в keys / fks для ALTER TABLE после
+    загрузки данных. PRIMARY KEY и ключ на AUTO_INCREMENT остаются."""
+    in_create, auto, prev = False, None, None
+    for line in lines:
+        if MYSQL_CREATE_RE.match(line):
+            in_create = True
+        elif in_create and line.startswith(b")"):
+            in_create = False
+            prev = prev.rstrip().rstrip(b",") + b"\n"
+        elif in_create:
+            body = line.strip().rstrip(b",")
+            if body.startswith(b"`") and b" AUTO_INCREMENT" in body:
+                auto = b"(" + body.split(b" ", 1)[0]
+            if body.startswith(b"CONSTRAINT "):
+                fks.append(body.decode())
+                continue
+            if body.startswith(MYSQL_SECONDARY_KEYS) and not (
+                auto and auto in body
+            ):
+                keys.append(body.decode())
+                continue
+        if prev is not None:
+            yield prev
+        prev = line
+    if prev is not None:
+        yield prev
+
+
+def mysql_load(*parts, lines_filter=None):
+    """Скармливает файлы (и строки SQL) одному процессу mysql через stdin."""
+    proc = subprocess.Popen(["sudo", "mysql"], stdin=subprocess.PIPE)
+    try:
+        for part in parts:
+            if isinstance(part, str):
+                proc.stdin.write(part.encode() + b"\n")
+                continue
+            with open(part, "rb") as f:
+                proc.stdin.writelines(lines_filter(f) if lines_filter else f)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    return proc.wait()
+
+
+def mysql_restore_tables(d, jobs):
+    """Параллельная загрузка базы из --sql-tables: таблицы без вторичных
+    индексов и FK в пуле, затем индексы (тоже в пуле), FK, views/routines."""
+    head = d / "_head.sql"
+    log(f"🗄️ Restore MySQL {d.name} (tables)")
+    mysql_load(head)
+    deferred = {}
+    tables = sorted((d / "tables").glob("*.sql"))
+    names = {}
+    if (d / "tables.tsv").exists():
+        for line in (d / "tables.tsv").read_text().splitlines():
+            fname, name = line.split("\t", 1)
+            names[fname] = name
+
+    def load(f):
+        keys, fks = deferred.setdefault(names.get(f.name, f.stem), ([], []))
+        return mysql_load(
+            head, f, lines_filter=lambda lines: mysql_defer_keys(lines, keys, fks)
+        )
+
+    failed = run_pool(
+        [
+            (f"MySQL {d.name}.{names.get(f.name, f.stem)}", partial(load, f))
+            for f in tables
+        ],
+        jobs
+    )
+    for i, title in ((0, "indexes"), (1, "foreign keys")):
+        alters = [
+            (
+                f"MySQL {d.name}.{t} {title}",
+                partial(
+                    mysql_load, head, "SET foreign_key_checks = 0;",
+                    f"ALTER TABLE `{t}` "
+                    + ", ".join(f"ADD {k}" for k in kf[i]) + ";"
+                )
+            )
+            for t, kf in sorted(deferred.items()) if kf[i]
+        ]
+        failed += run_pool(alters, jobs)
+    failed += [d.name] if mysql_load(head, d / "_tail.sql") else []
+    return failed
+
+
+def pg_restore_tables(d, jobs):
+    """Параллельная загрузка базы из --sql-tables: pre-data, \\copy таблиц
+    в пуле, затем post-data (индексы, PK, FK, триггеры)."""
+    psql = ["sudo", "-u", "postgres", "psql", "-X", "-q", "-v", "ON_ERROR_STOP=1"]
+    log(f"🗄️ Restore PG {d.name} (tables)")
+    run(["sudo", "-u", "postgres", "createdb", d.name], check=False)
+    run(psql + ["-f", str(d / "pre-data.sql"), d.name], check=False)
+    tasks = []
+    for line in (d / "tables.tsv").read_text().splitlines():
+        fname, ident = line.split("\t", 1)
+        tasks.append((
+            f"PG {d.name}.{ident}",
+            psql + ["-c", f"\\copy {ident} FROM '{d / fname}'", d.name]
+        ))
+    failed = run_pool(tasks, jobs)
+    log(f"🗄️ PG {d.name} post-data (indexes, constraints)")
+    if run(psql + ["-f", str(d / "post-data.sql"), d.name], check=False).returncode:
+        failed.append(f"PG {d.name} post-data")
+    return failed
+
+
+def sql_restore_dir(jobs):
+    """Восстановление дампов --sql-jobs / --sql-tables из SQL_DIR."""
+    failed = []
+    mysql_dir = SQL_DIR / "mysql"
+    if mysql_dir.is_dir() and have_cmd("mysql"):
+        # Целые базы — параллельно по базам
+        failed += run_pool([
+            (f"MySQL {f.stem}", f"sudo mysql < {shlex.quote(str(f))}")
+            for f in sorted(mysql_dir.glob("*.sql"))
+        ], jobs)
+        for d in sorted(x for x in mysql_dir.iterdir() if x.is_dir()):
+            failed += mysql_restore_tables(d, jobs)
+    pg_dir = SQL_DIR / "postgres"
+    if pg_dir.is_dir() and have_cmd("pg_restore"):
+        glob_sql = pg_dir / "globals.sql"
+        if glob_sql.exists():
+            log("🗄️ Restore PG globals")
+            run(
+                f"sudo -u postgres psql < {shlex.quote(str(glob_sql))}",
+                shell=True,
+                check=False
+            )
+        for d in sorted(x for x in pg_dir.iterdir() if x.is_dir()):
+            if (d / "tables.tsv").exists():
+                failed += pg_restore_tables(d, jobs)
+                continue
+            # Формат directory: pg_restore -j сам откладывает индексы
+            log(f"🗄️ Restore PG {d.name} (pg_restore -j {jobs})")
+            if run([
+                "sudo", "-u", "postgres", "pg_restore", "-j", str(jobs),
+                "--clean", "--if-exists", "--create", "-d", "template1", str(d)
+            ], check=False).returncode:
+                failed.append(f"PG {d.name}")
+    if failed:
+        log(f"❌ Restore failed: {', '.join(failed)}")
+
+
+def archive_paths(env, archive, *paths):
+    """Пути файлов в архиве (borg list), опционально под заданными путями."""
+    r = run(
+        ["borg", "list", "--format", "{path}{NL}", f"::{archive}", *paths],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=False
+    )
+    return [x for x in r.stdout.splitlines() if x]
+
+
+def sql_stream_sources(env, archive):
+    """(archive, path, клиент) для дампов, которые можно восстановить
+    прямо из репозитория: <archive>.sql и целые базы из SQL_DIR."""
+    sources = []
+    sql = companions(env, archive).get("sql")
+    if sql:
+        for path in archive_paths(env, sql):
+            sources.append((sql, path, "mysql" if "mysql" in path else "psql"))
+    rel = str(SQL_DIR).lstrip("/")
+    paths = set(archive_paths(env, archive, rel))
+    glob_sql = f"{rel}/postgres/globals.sql"
+    if glob_sql in paths:
+        sources.append((archive, glob_sql, "psql"))
+    for path in sorted(paths):
+        if re.fullmatch(re.escape(rel) + r"/mysql/[^/]+\.sql", path):
+            sources.append((archive, path, "mysql"))
+    return [src for src in sources if have_cmd(src[2])]
+
+
+@timed
+def sql_restore_stream(env, sources):
+    """borg extract --stdout | mysql/psql для каждого источника по очереди,
+    без промежуточных файлов."""
+    clients = {
+        "mysql": ["sudo", "mysql"],
+        "psql": ["sudo", "-u", "postgres", "psql", "-X", "-q"]
+    }
+    for archive, path, client in sources:
+        log(f"🗄️ Restore ::{archive}/{path} → {client}")
+        extract = subprocess.Popen(
+            ["borg", "extract", "--stdout", f"::{archive}", path],
+            env=env,
+            stdout=subprocess.PIPE
+        )
+        load = subprocess.Popen(clients[client], stdin=extract.stdout)
+        extract.stdout.close()  # SIGPIPE для borg, если клиент упадёт
+        if load.wait() or extract.wait():
+            log(f"❌ Restore {path} (borg {extract.returncode}, "
+                f"{client} {load.returncode})")
 
 
+@timed
 def save_system_state():
     log("📋 State save...")
     run(
@@ -170,6 +1803,7 @@ def save_system_state():
     )
 
 
+@timed
 def restore_system_state():
     log("🔧 State restore...")
     pkg = STATE_DIR / "packages.list"
@@ -197,12 +1831,151 @@ def maybe_fix_lxd_agent():
         run(["sudo", "systemctl", "start", "lxd-agent"], check=False)
 
 
+def iter_records(stream, limit=4096):
+    """Записи вывода процесса: чтение бинарными кусками из неблокирующего
+    fd, разделители и \\r, и \\n (прогресс borg перерисовывается через \\r
+    без перевода строки), неполные UTF-8 последовательности ждут
+    следующего куска. Запись длиннее limit обрезается — буфер ограничен."""
+    fd = stream.fileno()
+    os.set_blocking(fd, False)
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    sel = selectors.DefaultSelector()
+    sel.register(fd, selectors.EVENT_READ)
+    buf, skip = "", False
+    try:
+        while True:
+            sel.select()
+            try:
+                chunk = os.read(fd, 65536)
+            except BlockingIOError:
+                continue
+            buf += decoder.decode(chunk, final=not chunk)
+            *records, buf = re.split(r"[\r\n]", buf)
+            for rec in records:
+                if not skip and rec:
+                    yield rec[:limit]
+                skip = False
+            if len(buf) > limit:
+                # Хвост без разделителя: отдаём начало, остальное до \r/\n
+                if not skip:
+                    yield buf[:limit]
+                buf, skip = "", True
+            if not chunk:
+                if buf and not skip:
+                    yield buf
+                return
+    finally:
+        sel.close()
+
+
+SIZE_UNITS = {"B": 1, "kB": 10**3, "MB": 10**6, "GB": 10**9, "TB": 10**12}
+# borg create --progress: "1.2 GB O 800 MB C 90 MB D 1234 N path"
+CREATE_PROGRESS_RE = re.compile(
+    r"([\d.]+ [kMGT]?B) O ([\d.]+ [kMGT]?B) C ([\d.]+ [kMGT]?B) D (\d+) N ?(.*)"
+)
+# borg extract/check/delete --progress: "42.5% Extracting: path"
+PERCENT_PROGRESS_RE = re.compile(r"^\s*(\d{1,3}(?:\.\d+)?)% ?(.*)")
+
+
+def parse_size(text):
+    num, unit = text.split()
+    return int(float(num) * SIZE_UNITS[unit])
+
+
+@dataclass
+class Progress:
+    """Прогресс borg: события --log-json (archive_progress, progress_percent)
+    или разобранная строка --progress. Его читают LiveTail и METRICS."""
+    original_size: Optional[int] = None
+    compressed_size: Optional[int] = None
+    deduplicated_size: Optional[int] = None
+    nfiles: Optional[int] = None
+    current: Optional[int] = None    # progress_percent: current / total
+    total: Optional[int] = None
+    percent: Optional[float] = None
+    path: str = ""
+    finished: bool = False
+
+    @property
+    def bytes(self):
+        return self.original_size if self.current is None else self.current
+
+    def apply(self, event):
+        """Учитывает событие --log-json; возвращает текст для показа или None."""
+        kind = event.get("type")
+        if kind == "archive_progress":
+            for key in (
+                "original_size", "compressed_size", "deduplicated_size", "nfiles"
+            ):
+                if key in event:
+                    setattr(self, key, event[key])
+            self.path = event.get("path", self.path)
+            self.finished = event.get("finished", False)
+        elif kind == "progress_percent":
+            self.finished = event.get("finished", False)
+            if event.get("total"):
+                self.current, self.total = event["current"], event["total"]
+                self.percent = 100 * self.current / self.total
+            self.path = (event.get("info") or [self.path])[-1]
+        elif kind == "file_status":
+            return f"{event['status']} {event['path']}"
+        elif kind == "log_message":
+            level = event.get("levelname", "INFO")
+            msg = event.get("message")
+            return msg if level in ("DEBUG", "INFO") else f"{level}: {msg}"
+        return None
+
+    def metrics(self, prefix):
+        return {
+            f"{prefix}_{k}": v for k, v in asdict(self).items()
+            if isinstance(v, (int, float)) and not isinstance(v, bool)
+        }
+
+
+def parse_progress(line):
+    """Progress из текстовой строки прогресса borg (или None)."""
+    m = CREATE_PROGRESS_RE.search(line)
+    if m:
+        return Progress(
+            original_size=parse_size(m.group(1)),
+            compressed_size=parse_size(m.group(2)),
+            deduplicated_size=parse_size(m.group(3)),
+            nfiles=int(m.group(4)), path=m.group(5)
+        )
+    m = PERCENT_PROGRESS_RE.match(line)
+    if m:
+        return Progress(percent=float(m.group(1)), path=m.group(2))
+    return None
+
+
+def fmt_duration(sec):
+    sec = int(sec)
+    return f"{sec // 3600}:{sec // 60 % 60:02d}:{sec % 60:02d}"
+
+
 class LiveTail:
-    def __init__(self, lines: int = 5):
-        self.lines = lines
-        self.buf = deque(maxlen=lines)
-        self.percent = None
+    """Блок «прогресс + последние N строк» под курсором. update() только
+    копит строки; кадр рисуется не чаще fps раз в секунду, разбор прогресса
+    и скорости считаются на кадр, перерисовываются лишь изменённые строки.
+    Без TTY (cron) — компактный режим: сводка раз в summary_interval секунд,
+    последние keep строк печатаются только при ошибке, в конце — итог."""
+
+    summary_interval = 60.0
+    keep = 50
+
+    def __init__(self, lines: int = 5, fps: float = 10, model=None):
         self.ansi = sys.stdout.isatty()
+        self.lines = lines
+        self.buf = deque(maxlen=lines if self.ansi else self.keep)
+        self.interval = 1 / fps if self.ansi else self.summary_interval
+        self.next_draw = 0.0 if self.ansi else time.monotonic() + self.interval
+        self.dirty = False
+        self.model = model               # Progress из событий --log-json
+        self.progress = None             # последняя строка прогресса borg
+        self.count = 0                   # прочие строки (файлы при --list)
+        self.t0 = time.monotonic()
+        self.samples = deque(maxlen=30)  # (t, bytes, files) по кадрам
+        self.shown = [None] * (lines + 1)
         if self.ansi:
             # Резервируем место под (progress + N строк) под текущим курсором
             print("\n" * (lines + 1), end="")
@@ -212,80 +1985,314 @@ class LiveTail:
         line = line.rstrip("\n")
         if not line:
             return
+        if self.model is not None and line[:1] == "{":
+            try:
+                line = self.model.apply(json.loads(line))
+            except (ValueError, AttributeError, KeyError):
+                pass  # не событие borg — показываем как есть
 
-        # Вытаскиваем проценты, если есть
-        m = re.search(r"(\d{1,3})%", line)
-        if m:
-            self.percent = m.group(1)
-
-        self.buf.append(line)
-
-        # Если не TTY (лог в файл / pipe) — просто печатаем
+        # Дешёвый отбор без regex; точный разбор — только при отрисовке
+        if not line:
+            pass  # событие прогресса уже учтено в model
+        elif self.model is None and ("% " in line or " N " in line):
+            self.progress = line
+        else:
+            self.count += 1
+            self.buf.append(line)
+            if not self.ansi and line.startswith(("WARNING", "ERROR")):
+                print(line, flush=True)  # предупреждения borg не копим
+        now = time.monotonic()
+        if now >= self.next_draw:
+            self.draw(now)
+        else:
+            self.dirty = True
+
+    def status(self, now):
+        p = self.model or (
+            self.progress and parse_progress(self.progress)
+        ) or Progress()
+        files = self.count if p.nfiles is None else p.nfiles
+        self.samples.append((now, p.bytes, files))
+        # Без --list и без nfiles число файлов неизвестно — не показываем
+        # Окно скорости — от самого старого кадра, где объём уже известен
+        t, b, f = next(
+            (x for x in self.samples if x[1] is not None), self.samples[0]
+        )
+        dt = now - t
+        parts = [
+            "Progress: --%" if p.percent is None
+            else f"Progress: {p.percent:.1f}%"
+        ]
+        if p.bytes is not None:
+            parts.append(fmt_size(p.bytes))
+            if dt > 0 and b is not None:
+                parts.append(f"{fmt_size((p.bytes - b) / dt)}/s")
+        if files:
+            parts.append(f"{files} files")
+            if dt > 0:
+                parts.append(f"{(files - f) / dt:.0f} files/s")
+        elapsed = now - self.t0
+        parts.append(fmt_duration(elapsed))
+        if p.percent:
+            eta = elapsed * (100 - p.percent) / p.percent
+            parts.append(f"ETA {fmt_duration(eta)}")
+        return " | ".join(parts)
+
+    def draw(self, now):
+        self.next_draw = now + self.interval
+        self.dirty = False
         if not self.ansi:
-            print(line)
+            print(self.status(now), flush=True)
             return
-
-        # Двигаем курсор ВВЕРХ на (lines + 1) строк и перерисовываем блок
-        up = self.lines + 1
-        sys.stdout.write(f"\033[{up}F")  # move cursor up
-
-        # Строка прогресса
-        pct = self.percent or "--"
-        sys.stdout.write("\033[2K")      # clear line
-        sys.stdout.write(f"Progress: {pct}%\n")
-
-        # Последние N строк
-        buf_list = list(self.buf)
-        for i in range(self.lines):
-            sys.stdout.write("\033[2K")  # clear line
-            if i < len(buf_list):
-                sys.stdout.write(buf_list[i][:160])
-            sys.stdout.write("\n")
-
+        frame = [self.status(now)] + [x[:160] for x in self.buf]
+        frame += [""] * (self.lines + 1 - len(frame))
+        # Курсор ВВЕРХ на (lines + 1) строк; неизменённые строки пропускаем
+        out = [f"\033[{self.lines + 1}F"]
+        for i, text in enumerate(frame):
+            if text != self.shown[i]:
+                out.append(f"\033[2K{text}")
+            out.append("\n")
+        self.shown = frame
+        sys.stdout.write("".join(out))
         sys.stdout.flush()
 
-    def finish(self):
-        # Ничего не печатаем, чтобы не сдвигать историю
+    def finish(self, ok=True):
+        now = time.monotonic()
         if self.ansi:
-            pass
-
-
-def stream_command(cmd, env=None, cwd="/", title="Process", use_live_tail=True):
-    """Выполняет команду, показывает live-tail (если use_live_tail=True)
-    или просто прокидывает вывод."""
-    print(f"\n=== {title} ===")
-
-    if use_live_tail and sys.stdout.isatty():
-        tail = LiveTail()
-        proc = subprocess.Popen(
-            cmd,
-            env=env,
-            cwd=cwd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1
-        )
+            # Последний кадр, историю выше блока не сдвигаем
+            if self.dirty:
+                self.draw(now)
+            return
+        if not ok and self.buf:
+            print(f"--- last {len(self.buf)} lines ---")
+            print("\n".join(self.buf))
+        print(f"Done: {self.status(now)}", flush=True)
+
+
+def proc_tree(root):
+    """PID root и всех его потомков (sudo → borg → ssh)."""
+    children = {}
+    for d in os.scandir("/proc"):
+        if not d.name.isdigit():
+            continue
         try:
-            for line in iter(proc.stdout.readline, ""):
-                tail.update(line)
-        finally:
-            proc.stdout.close()
-            proc.wait()
-            tail.finish()
-    else:
-        # Без LiveTail — обычный вывод, без ANSI-магии
-        proc = subprocess.run(
-            cmd,
-            env=env,
-            cwd=cwd,
-            check=False
+            stat = Path(d.path, "stat").read_text()
+        except OSError:
+            continue
+        ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(d.name))
+    tree, todo = [], [root]
+    while todo:
+        pid = todo.pop()
+        tree.append(pid)
+        todo += children.get(pid, [])
+    return tree
+
+
+def tcp_queues(inodes):
+    """Сумма (tx_queue, rx_queue) TCP-сокетов с данными inode."""
+    tx = rx = 0
+    for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            lines = Path(table).read_text().splitlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            f = line.split()
+            if f[9] in inodes:
+                t, r = f[4].split(":")
+                tx, rx = tx + int(t, 16), rx + int(r, 16)
+    return tx, rx
+
+
+class ProcSampler:
+    """Раз в interval секунд читает /proc дерева процессов команды: CPU и
+    состояние (stat), чтение (io), очереди TCP-сокетов (ssh к репозиторию).
+    classify() — чем был ограничен запуск, с цифрами-доказательствами."""
+
+    def __init__(self, pid, interval=1.0):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+
+    def loop(self):
+        while not self.done.wait(self.interval):
+            self.samples.append(self.sample())
+
+    def sample(self):
+        procs, inodes, read = {}, set(), 0
+        for pid in proc_tree(self.pid):
+            try:
+                stat = Path(f"/proc/{pid}/stat").read_text()
+                f = stat[stat.rindex(")") + 2:].split()
+                name = stat[stat.index("(") + 1:stat.rindex(")")]
+                procs[pid] = (name, f[0], int(f[11]) + int(f[12]))
+                io = Path(f"/proc/{pid}/io").read_text()
+                read += int(re.search(r"^read_bytes: (\d+)", io, re.M).group(1))
+                for fd in os.scandir(f"/proc/{pid}/fd"):
+                    link = os.readlink(fd.path)
+                    if link.startswith("socket:["):
+                        inodes.add(link[8:-1])
+            except (OSError, AttributeError):
+                continue  # процесс завершился или нет прав
+        tx, rx = tcp_queues(inodes)
+        return dict(t=time.monotonic(), procs=procs, read=read, tx=tx, rx=rx)
+
+    def classify(self):
+        samples = [x for x in self.samples if x["procs"]]
+        if len(samples) < 2:
+            return {"class": "unknown", "evidence": {"samples": len(samples)}}
+        # По каждому PID — первый и последний замер: процессы дерева
+        # появляются и завершаются по ходу запуска
+        seen = {}
+        for x in samples:
+            for pid, (name, _, ticks) in x["procs"].items():
+                seen.setdefault(pid, [name, x["t"], ticks, None, None])
+                seen[pid][3:] = [x["t"], ticks]
+        tick = os.sysconf("SC_CLK_TCK")
+        cpu, top = 0.0, "-"
+        for name, t0, c0, t1, c1 in seen.values():
+            if t1 > t0 and (c1 - c0) / tick / (t1 - t0) > cpu:
+                cpu, top = (c1 - c0) / tick / (t1 - t0), name
+        wall = samples[-1]["t"] - samples[0]["t"]
+        read = sum(
+            max(b["read"] - a["read"], 0) for a, b in zip(samples, samples[1:])
         )
-
-    if proc.returncode:
-        log(f"❌ Exit {proc.returncode}")
-        sys.exit(1)
-    log("✅ OK")
+        d_state = sum(
+            any(st == "D" for _, st, _ in x["procs"].values()) for x in samples
+        ) / len(samples)
+        evidence = {
+            "samples": len(samples),
+            "busiest": top,
+            "cpu_core_fraction": round(cpu, 3),
+            "d_state_fraction": round(d_state, 3),
+            "read_bytes_per_second": round(read / wall),
+            "avg_tcp_send_queue": round(
+                sum(x["tx"] for x in samples) / len(samples)
+            ),
+        }
+        # Ядро загружено — упираемся в сжатие/хеширование; очередь отправки
+        # не пустеет — в сеть; процессы в D — ждут диск
+        if cpu >= 0.85:
+            kind = "cpu-bound"
+        elif evidence["avg_tcp_send_queue"] >= 256 * 1024:
+            kind = "network-bound"
+        elif d_state >= 0.3:
+            kind = "read-bound"
+        else:
+            kind = "undetermined"
+        return {"class": kind, "evidence": evidence}
+
+
+def stream_command(cmd, env=None, cwd="/", title="Process", use_live_tail=True,
+                   capture_stdout=False, progress=None, sample=False):
+    """Выполняет команду, показывает live-tail (если use_live_tail=True)
+    или просто прокидывает вывод. С capture_stdout=True stdout (например,
+    borg --json) не смешивается с прогрессом в stderr и возвращается.
+    С progress=Progress() borg запускается с --log-json, события
+    обновляют этот объект. sample=True — ProcSampler, итог в
+    METRICS["bottleneck"]."""
+    print(f"\n=== {title} ===")
+    with span(cmd_name(cmd), "cmd"):
+        out = []
+        if progress is not None:
+            cmd = cmd + ["--log-json"]
+
+        if use_live_tail and sys.stdout.isatty() or progress is not None:
+            tail = LiveTail(model=progress)
+            proc = subprocess.Popen(
+                cmd,
+                env=env,
+                cwd=cwd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE if capture_stdout else subprocess.STDOUT
+            )
+            sampler = ProcSampler(proc.pid).start() if sample else None
+            stream = proc.stderr if capture_stdout else proc.stdout
+            reader = threading.Thread(target=lambda: out.append(
+                proc.stdout.read().decode(errors="replace")
+            ))
+            if capture_stdout:
+                reader.start()
+            try:
+                for line in iter_records(stream):
+                    tail.update(line)
+            finally:
+                if capture_stdout:
+                    reader.join()
+                stream.close()
+                proc.wait()
+                tail.finish(proc.returncode == 0)
+                if sampler:
+                    sampler.stop()
+                    METRICS["bottleneck"] = verdict = sampler.classify()
+                    log(f"🔎 {verdict['class']}: {verdict['evidence']}")
+        else:
+            # Без LiveTail — обычный вывод, без ANSI-магии
+            proc = subprocess.run(
+                cmd,
+                env=env,
+                cwd=cwd,
+                stdout=subprocess.PIPE if capture_stdout else None,
+                text=True,
+                check=False
+            )
+            out.append(proc.stdout or "")
+
+        if proc.returncode:
+            log(f"❌ Exit {proc.returncode}")
+            sys.exit(1)
+        log("✅ OK")
+        return "".join(out)
+
+
+def fmt_size(n):
+    for unit in ("B", "kB", "MB", "GB", "TB"):
+        if abs(n) < 1000 or unit == "TB":
+            return f"{n:.1f} {unit}" if unit != "B" else f"{n:.0f} B"
+        n /= 1000
+
+
+def save_create_stats(report):
+    """Статистика borg create --json → STATE_DIR/last-create.json и лог;
+    заменяет отдельные borg info / list после бэкапа."""
+    a = report.get("archive", {})
+    st = a.get("stats", {})
+    stats = {
+        "archive": a.get("name"),
+        "start": a.get("start"),
+        "end": a.get("end"),
+        "duration": a.get("duration"),
+        "nfiles": st.get("nfiles"),
+        "original_size": st.get("original_size"),
+        "compressed_size": st.get("compressed_size"),
+        "deduplicated_size": st.get("deduplicated_size"),
+        "repository_unique_csize": (
+            report.get("cache", {}).get("stats", {}).get("unique_csize")
+        ),
+    }
+    save_json(STATE_DIR / "last-create.json", stats)
+    METRICS.update({
+        f"archive_{k}": v for k, v in stats.items()
+        if isinstance(v, (int, float))
+    })
+    log(
+        f"📊 {stats['archive']}: {stats['nfiles']} files, "
+        f"{fmt_size(stats['original_size'] or 0)} → "
+        f"{fmt_size(stats['compressed_size'] or 0)} compressed, "
+        f"{fmt_size(stats['deduplicated_size'] or 0)} new, "
+        f"{stats['duration'] or 0:.0f}s"
+    )
 
 
 def build_env(args):
@@ -309,12 +2316,49 @@ def build_env(args):
     return env
 
 
+@timed
 def init_repo(env):
     if run(["borg", "list"], env=env, capture_output=True, check=False).returncode:
         log("➕ Init...")
         run(["borg", "init", "--encryption", "repokey-blake2"], env=env)
 
 
+def companion(archive, kind):
+    """Имя вспомогательного архива (дампы и т.п.) для основного архива."""
+    return f"{archive}.{kind}"
+
+
+def companions(env, archive):
+    """{kind: name} вспомогательных архивов, созданных вместе с archive."""
+    r = run(
+        ["borg", "list", "--short", "--glob-archives", companion(archive, "*")],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=False
+    )
+    names = [x.strip() for x in r.stdout.splitlines() if x.strip()]
+    return {n[len(archive) + 1:]: n for n in names}
+
+
+def archive_groups(env):
+    """[(archive, {kind: companion})] всех архивов в порядке создания."""
+    r = run(
+        ["borg", "list", "--short"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=False
+    )
+    groups = {}
+    for name in [x.strip() for x in r.stdout.splitlines() if x.strip()]:
+        base, _, kind = name.partition(".")
+        extra = groups.setdefault(base, {})
+        if kind:
+            extra[kind] = name
+    return list(groups.items())
+
+
 def list_archives(env):
     r = run(
         ["borg", "list", "--format", "{archive}{TAB}{time}{NL}"],
@@ -328,13 +2372,13 @@ def list_archives(env):
     print("\n📋 Archives:")
     print("─" * 60)
     archives = []
-    for i, line in enumerate(
-        [x.strip() for x in r.stdout.splitlines() if x.strip()], 1
-    ):
+    for line in [x.strip() for x in r.stdout.splitlines() if x.strip()]:
         parts = line.split("\t")
         name = parts[0]
         t = parts[1] if len(parts) > 1 else ""
-        print(f"{i}. {name:<40} {t}")
+        if "." in name:
+            continue  # вспомогательный архив (<archive>.sql и т.п.)
+        print(f"{len(archives) + 1}. {name:<40} {t}")
         archives.append(name)
     print("─" * 60)
     return archives
@@ -359,13 +2403,20 @@ def select_archive(env):
         print("❌ Invalid")
 
 
+@timed
 def archive_info(env, archive):
     print(f"\n📊 {archive}")
-    stream_command(["borg", "info", f"::{archive}"], env=env, title="Info")
+    # Прогресса у info/list нет, вывод и есть отчёт: печатается целиком,
+    # а не сворачивается в LiveTail
+    stream_command(
+        ["borg", "info", f"::{archive}"], env=env, title="Info",
+        use_live_tail=False
+    )
     stream_command(
         ["borg", "list", f"::{archive}", "--last", "5"],
         env=env,
-        title="Last 5"
+        title="Last 5",
+        use_live_tail=False
     )
 
 
@@ -374,9 +2425,11 @@ def clear_all(env):
     if input("Write 'DELETE ALL' and press ENTER: ").strip() != "DELETE ALL":
         return
 
+    # Без терминала --progress сыпал бы в лог строками с \r
+    progress = ["--progress"] if sys.stdout.isatty() else []
     print("👉 Now running: borg delete ...")
     stream_command(
-        ["borg", "delete", "--progress", "--stats", "--glob-archives", "*"],
+        ["borg", "delete"] + progress + ["--stats", "--glob-archives", "*"],
         env=env,
         title="DELETE",
         use_live_tail=False  # важно: без LiveTail, чтобы не было сдвига вверх
@@ -384,41 +2437,384 @@ def clear_all(env):
 
     print("👉 Now running: borg compact ...")
     stream_command(
-        ["borg", "compact"],
+        ["borg", "compact"] + progress,
         env=env,
         title="Compact",
         use_live_tail=False  # тоже без LiveTail
     )
 
 
-def do_backup(env, all_mode):
-    docker = all_mode and docker_active()
-    if docker:
-        docker_stop()
-    if all_mode:
-        save_system_state()
-    sql = sql_dump() if all_mode else []
+def compression_sample(dest, excludes, limit=64 * 2**20):
+    """Копирует в dest до limit байт данных хоста (поровну с каждого корня
+    COMPRESSION_SAMPLE_ROOTS, до 4 МБ с файла). Возвращает объём."""
+    quota = limit // len(COMPRESSION_SAMPLE_ROOTS)
+    total = 0
+    for root in COMPRESSION_SAMPLE_ROOTS:
+        taken = 0
+        for dirpath, dirs, files in os.walk(root):
+            dirs[:] = [
+                d for d in dirs
+                if not excluded(os.path.join(dirpath, d), excludes)
+            ]
+            for name in files:
+                src = os.path.join(dirpath, name)
+                if taken >= quota:
+                    break
+                if os.path.islink(src) or excluded(src, excludes):
+                    continue
+                try:
+                    with open(src, "rb") as f:
+                        data = f.read(min(4 * 2**20, quota - taken))
+                except OSError:
+                    continue
+                Path(dest, f"{total + taken:012d}").write_bytes(data)
+                taken += len(data)
+            if taken >= quota:
+                break
+        total += taken
+    return total
+
+
+def compression_bench(tmp, sample):
+    """{spec: (байт/с, сжатый/исходный)}: borg create образца во временный
+    локальный репозиторий (свой на каждого кандидата, без дедупликации
+    между ними). Скорость включает чанкинг и хеширование — как в бэкапе."""
+    env = dict(
+        os.environ, BORG_BASE_DIR=str(tmp), BORG_PASSPHRASE="",
+        BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK="yes"
+    )
+    results = {}
+    for i, spec in enumerate(COMPRESSION_CANDIDATES):
+        repo = Path(tmp, f"repo{i}")
+        run(["borg", "init", "-e", "none", str(repo)], env=env,
+            capture_output=True, check=False)
+        t0 = time.monotonic()
+        r = run(
+            ["borg", "create", "--json", "--compression", spec,
+             f"{repo}::bench", "."],
+            env=env, cwd=sample, capture_output=True, text=True, check=False
+        )
+        seconds = time.monotonic() - t0
+        shutil.rmtree(repo, ignore_errors=True)
+        if r.returncode:
+            log(f"⚠️ {spec}: {r.stderr.strip()[-200:]}")
+            continue
+        st = json.loads(r.stdout)["archive"]["stats"]
+        results[spec] = (
+            st["original_size"] / seconds,
+            st["compressed_size"] / max(st["original_size"], 1)
+        )
+    return results
+
+
+def repo_ssh_target(repo):
+    """(user, host, port) ssh-репозитория borg или None для локального.
+
+    >>> repo_ssh_target("ssh://user@host:/path/repo")
+    ('user', 'host', None)
+    >>> repo_ssh_target("ssh://user@host:2222/./repo")
+    ('user', 'host', '2222')
+    >>> repo_ssh_target("ssh://host/path/repo")
+    (None, 'host', None)
+    >>> repo_ssh_target("user@host:path/repo")
+    ('user', 'host', None)
+    >>> repo_ssh_target("/var/backups/repo") is None
+    True
+    """
+    m = (
+        re.match(r"ssh://(?:([^@/]+)@)?([^:/]+)(?::(\d*))?/", repo)
+        or re.match(r"(?:([^@/:]+)@)?([^:/]+):(?!//)()", repo)
+    )
+    if not m:
+        return None
+    user, host, port = m.groups()
+    return user, host, port or None
+
+
+def repo_link_speed(env, size=16 * 2**20, timeout=60):
+    """Байт/с до хоста репозитория: size случайных байт через ssh (с
+    BORG_RSH) в /dev/null минус время соединения. None — замер не удался
+    (в т.ч. ключ ограничен command="borg serve ...") или дольше timeout."""
+    user, host, port = repo_ssh_target(env["BORG_REPO"])
+    ssh = shlex.split(env.get("BORG_RSH", "ssh")) + (["-p", port] if port else [])
+    ssh.append(f"{user}@{host}" if user else host)
+    try:
+        t0 = time.monotonic()
+        r = run(ssh + ["true"], env=env, capture_output=True,
+                stdin=subprocess.DEVNULL, timeout=timeout, check=False)
+        if r.returncode:
+            return None
+        connect = time.monotonic() - t0
+        t0 = time.monotonic()
+        r = run(
+            ssh + ["cat > /dev/null"], env=env, input=os.urandom(size),
+            capture_output=True, timeout=timeout, check=False
+        )
+    except subprocess.TimeoutExpired:
+        return None
+    seconds = time.monotonic() - t0 - connect
+    return size / seconds if not r.returncode and seconds > 0 else None
+
+
+@timed
+def choose_compression(env, excludes, every_days=7):
+    """--compression auto: кандидат с наименьшим временем на байт новых
+    данных, max(сжатие, отправка сжатого) — borg и ssh работают конвейером.
+    Выбор кэшируется в STATE_DIR/compression.json на every_days дней."""
+    cache = load_json(COMPRESSION_CACHE, {})
+    if (
+        cache.get("repo") == env["BORG_REPO"]
+        and time.time() - cache.get("measured", 0) < every_days * 86400
+    ):
+        return cache["choice"]
+    remote = repo_ssh_target(env["BORG_REPO"]) is not None
+    link = repo_link_speed(env) if remote else None
+    if remote and not link:
+        # Без замера канала удалённый репозиторий не считается локальным,
+        # иначе выиграл бы lz4 и попал в кэш; замер — при следующем запуске
+        log(f"⚠️ Repository link speed not measured, using {COMPRESSION}")
+        return COMPRESSION
+    log("🧪 Compression benchmark...")
+    with tempfile.TemporaryDirectory(dir="/var/tmp") as tmp:
+        sample = Path(tmp, "sample")
+        sample.mkdir()
+        size = compression_sample(sample, excludes)
+        bench = compression_bench(tmp, sample) if size else {}
+    if not bench:
+        log(f"⚠️ Compression benchmark failed, using {COMPRESSION}")
+        return COMPRESSION
+
+    def cost(spec):
+        speed, ratio = bench[spec]
+        return max(1 / speed, ratio / link if link else 0)
+
+    choice = min(bench, key=cost)
+    save_json(COMPRESSION_CACHE, {
+        "repo": env["BORG_REPO"],
+        "measured": time.time(),
+        "choice": choice,
+        "sample_bytes": size,
+        "link_bytes_per_second": link and round(link),
+        "candidates": {
+            spec: {
+                "bytes_per_second": round(speed),
+                "ratio": round(ratio, 4),
+                "seconds_per_gb": round(cost(spec) * 1e9, 1),
+            }
+            for spec, (speed, ratio) in bench.items()
+        },
+    })
+    log(
+        f"🧪 Compression {choice}: {fmt_size(bench[choice][0])}/s, "
+        f"ratio {bench[choice][1]:.2f}, link "
+        f"{fmt_size(link) + '/s' if link else 'local'}"
+    )
+    return choice
+
+
+class Phases:
+    """Фазы запуска: захват → возврат сервисов → фоновая пост-обработка.
+    resume() выполняет колбэки возврата один раз, в обратном порядке;
+    background() запускает задачу в потоке, её время пишется в METRICS."""
+
+    def __init__(self):
+        self.resumers = []
+        self.threads = []
+        self.t0 = time.monotonic()
+
+    def on_resume(self, fn):
+        self.resumers.append(fn)
+
+    def resume(self):
+        if self.resumers:
+            METRICS["capture_seconds"] = round(time.monotonic() - self.t0, 3)
+        while self.resumers:
+            self.resumers.pop()()
+
+    def background(self, name, fn, *args):
+        def task():
+            t0 = time.monotonic()
+            try:
+                with span(name):
+                    fn(*args)
+            except (Exception, SystemExit) as e:
+                log(f"⚠️ {name} failed: {e}")
+            METRICS[f"post_{name}_seconds"] = round(time.monotonic() - t0, 3)
+
+        t = threading.Thread(target=task, name=name)
+        t.start()
+        self.threads.append(t)
+
+    def join(self):
+        for t in self.threads:
+            t.join()
+
+
+def do_backup(env, args):
+    all_mode = args.all
     archive = (
         f"{socket.gethostname().split('.')[0]}-"
         f"{time.strftime('%Y-%m-%d_%H-%M-%S')}"
     )
     excludes = BASE_EXCLUDES + (IDENTITY_EXCLUDES if all_mode else [])
-    cmd = [
-        "borg", "create", f"::{archive}", "/",
-        "--stats", "--progress",
-        "--compression", "zstd,6",
-        "--exclude-caches"
-    ] + sum([["--exclude", ex] for ex in excludes], [])
-    stream_command(cmd, env=env, title=f"BACKUP {archive}")
-    archive_info(env, archive)
-    for f in sql:
-        Path(f).unlink(missing_ok=True)
+    compression = (
+        choose_compression(env, excludes, args.compression_every)
+        if args.compression == "auto" else args.compression
+    )
+    SETTINGS.update(archive=archive, compression=compression, excludes=excludes)
+    # Точка согласованности — до решения об остановке Docker: без копий
+    # в --freeze-output контейнеры всё же останавливаются
+    covered = args.fsfreeze and freeze_point(args, excludes)
+    docker = (
+        all_mode and args.docker == "stop" and not covered and docker_active()
+    )
+    if all_mode and args.docker == "dbs":
+        # Базы в контейнерах дампятся на ходу, демон не останавливается
+        docker_dump(env, archive)
+    if all_mode and args.docker in ("pause", "quiesce"):
+        # Только контейнеры с данными и только на время копии их томов
+        excludes = excludes + docker_capture(
+            env, archive, excludes, "pause" if args.docker == "pause" else "stop"
+        )
+    phases = Phases()
     if docker:
-        docker_start()
+        docker_stop(args.docker_timeout)
+        phases.on_resume(partial(docker_start, args.docker_timeout))
+    try:
+        dumps = backup_capture(
+            env, args, archive, excludes, phases, compression
+        )
+    finally:
+        # Данные захвачены (или захват упал) — сервисы поднимаются сразу
+        phases.resume()
+    # Отчёт и уборка не держат сервисы остановленными
+    if args.info:
+        phases.background("info", archive_info, env, archive)
+    phases.background("cleanup", remove_dumps, dumps)
+    phases.join()
+
+
+def freeze_point(args, excludes):
+    """--fsfreeze: точка согласованности. borg читает живую ФС уже после
+    разморозки, согласованы только копии, которые хуки сделали в
+    --freeze-output; её ФС не замораживается. True — копии появились."""
+    out = args.freeze_output
+    mounts = ["/"] + other_mounts("/", excludes)
+    before = {}
+    if out:
+        Path(out).mkdir(parents=True, exist_ok=True)
+        own = mount_of(out)
+        mounts = [m for m in mounts if m != own]
+        before = file_stamps(out)
+    meta = consistency_point(mounts, args.freeze_hook, args.freeze_timeout)
+    meta["output"] = out
+    save_json(STATE_DIR / "consistency.json", meta)
+    for h in meta["hooks"]:
+        if h["rc"]:
+            log(f"⚠️ Freeze hook failed ({h['rc']}): {h['cmd']}")
+            if h["stderr"]:
+                log(f"   {h['stderr'].strip().splitlines()[-1]}")
+    if not out:
+        log("⚠️ fsfreeze point does not cover the archive: borg reads live "
+            "files after thaw")
+        return False
+    if file_stamps(out) == before:
+        log(f"⚠️ --freeze-output {out}: hooks produced nothing, "
+            "falling back to stopping Docker")
+        return False
+    if excluded(out, excludes):
+        log(f"⚠️ --freeze-output {out} is excluded from the archive, "
+            "falling back to stopping Docker")
+        return False
+    return True
+
+
+def file_stamps(root):
+    """{путь: (mtime_ns, size)} всех файлов под root — чтобы отличить
+    свежие копии хуков от оставшихся с прошлого запуска."""
+    stamps = {}
+    for f in Path(root).rglob("*"):
+        if f.is_file():
+            st = f.stat()
+            stamps[str(f)] = (st.st_mtime_ns, st.st_size)
+    return stamps
+
+
+def backup_capture(env, args, archive, excludes, phases, compression):
+    """Фаза захвата: точка согласованности, дампы, borg create.
+    Возвращает временные файлы для уборки."""
+    all_mode = args.all
+    if all_mode:
+        save_system_state()
+    dumps = []
+    tier = all_mode and args.sql_full_every
+    full = all_mode and (not tier or sql_full_due(args.sql_full_every))
+    if full and args.pg_physical:
+        pg_physical_backup(env, archive)
+    if full and args.mysql_physical:
+        mysql_physical_backup(env, archive)
+    logical = dict(pg=not args.pg_physical, mysql=not args.mysql_physical)
+    if full and (args.sql_stream or tier):
+        # Для PITR полный дамп должен лежать в репозитории (<archive>.sql)
+        sql_stream(env, archive, binlog_pos=tier, **logical)
+    elif full:
+        dumps = sql_dump(args.sql_jobs, args.sql_tables, **logical)
+    if tier:
+        sql_increments(
+            env, archive, Path(args.pg_wal_dir), pg_wal=args.pg_physical
+        )
+        if full:
+            state = load_json(SQL_TIER_STATE, {})
+            state["last_full"] = time.time()
+            save_json(SQL_TIER_STATE, state)
+    dumps += store_snapshots(args.store)
+    with contextlib.ExitStack() as stack:
+        cwd, paths, wrap = "/", ["/"], []
+        if args.snapshot:
+            mount = args.snapshot_mount
+            try:
+                snap = stack.enter_context(
+                    fs_snapshot(args.snapshot, mount, args.snapshot_size)
+                )
+            finally:
+                # Снимок сделан (или не удался) — сервисы поднимаем сразу
+                phases.resume()
+            live = other_mounts(mount, excludes)
+            if live:
+                log(f"⚠️ Not in snapshot, read live: {', '.join(live)}")
+            if mount == "/":
+                cwd, paths = str(snap), ["."] + live
+            else:
+                # Снимок подменяет mount только в частном пространстве имён
+                # borg: пути в архиве остаются прежними
+                wrap = [
+                    "unshare", "-m", "--propagation", "private", "sh", "-c",
+                    'mount --bind "$0" "$1" && shift && exec "$@"',
+                    str(snap), mount
+                ]
+        cmd = wrap + [
+            "borg", "create", f"::{archive}",
+            "--json", "--progress",
+            "--compression", compression,
+            "--exclude-caches"
+        ] + sum([["--exclude", ex] for ex in excludes], []) + paths
+        progress = Progress()
+        with span("borg_create"):
+            out = stream_command(
+                cmd, env=env, cwd=cwd, title=f"BACKUP {archive}",
+                capture_stdout=True, progress=progress, sample=args.profile
+            )
+        METRICS.update(progress.metrics("create"))
+    try:
+        save_create_stats(json.loads(out))
+    except ValueError:
+        log("⚠️ No JSON stats from borg create")
+    return dumps
 
 
-def do_restore(env, target, all_mode):
-    tp = Path(target).resolve()
+def do_restore(env, args):
+    all_mode = args.all
+    tp = Path(args.target).resolve()
     if not tp.exists():
         print(f"❌ {tp}")
         sys.exit(2)
@@ -427,13 +2823,69 @@ def do_restore(env, target, all_mode):
     print(f"🎯 {tp}")
     if input("Overwrite? y/N: ").lower() != 'y':
         return
+    # Список файлов — только в терминал; в cron-лог идут сводки прогресса
     cmd = [
-        "sudo", "-E", "borg", "extract", f"::{archive}",
-        "--list", "--progress"
-    ] + sum([["--exclude", ex] for ex in DEFAULT_RESTORE_EXCLUDES], [])
-    stream_command(cmd, env=env, cwd=str(tp), title="RESTORE")
+        "sudo", "-E", "borg", "extract", f"::{archive}", "--progress"
+    ] + (["--list"] if sys.stdout.isatty() else []) + sum(
+        [["--exclude", ex] for ex in DEFAULT_RESTORE_EXCLUDES], []
+    )
+    streams = []
+    if all_mode and args.sql_stream and not args.until:
+        # Базы грузятся из репозитория параллельно с распаковкой файлов
+        streams = sql_stream_sources(env, archive)
+        cmd += sum(
+            [["--exclude", path] for a, path, _ in streams if a == archive], []
+        )
+    worker = threading.Thread(
+        target=sql_restore_stream, args=(env, streams), name="sql-restore"
+    )
+    worker.start()
+    progress = Progress()
+    with span("borg_extract"):
+        stream_command(
+            cmd, env=env, cwd=str(tp), title="RESTORE", progress=progress,
+            sample=args.profile
+        )
+    METRICS.update(progress.metrics("extract"))
+    worker.join()
+    volumes = companions(env, archive).get("volumes")
+    if volumes:
+        stream_command(
+            ["sudo", "-E", "borg", "extract", f"::{volumes}", "--progress"]
+            + sum([["--exclude", ex] for ex in DEFAULT_RESTORE_EXCLUDES], []),
+            env=env,
+            cwd=str(tp),
+            title="RESTORE VOLUMES",
+            progress=Progress()
+        )
+    if all_mode and args.until:
+        sql_pitr_restore(
+            env, archive, args.until,
+            args.pg_service, args.pg_datadir, Path(args.pg_wal_dir)
+        )
+    elif all_mode:
+        extra = companions(env, archive)
+        if "pgbase" in extra:
+            pg_physical_restore(
+                env, extra["pgbase"], args.pg_service, args.pg_datadir
+            )
+        if "mysqlbase" in extra:
+            mysql_physical_restore(
+                env, extra["mysqlbase"], args.mysql_service, args.mysql_datadir
+            )
+        if "docker" in extra:
+            docker_restore_dumps(env, extra["docker"])
+        sql = not streams and extra.get("sql")
+        if sql:
+            # Дампы из <archive>.sql (--sql-stream) → /tmp для sql_restore()
+            stream_command(
+                ["sudo", "-E", "borg", "extract", f"::{sql}"],
+                env=env,
+                cwd="/tmp",
+                title=f"SQL {sql}"
+            )
+        sql_restore(max(args.sql_jobs, 1))
     if all_mode:
-        sql_restore()
         restore_system_state()
         maybe_fix_lxd_agent()
     log("✅ Reboot?")
@@ -441,38 +2893,194 @@ def do_restore(env, target, all_mode):
 
 def main():
     p = argparse.ArgumentParser(description="BorgBackup")
-    p.add_argument("--repo", required=True)
-    p.add_argument("--key", required=True)
+    p.add_argument("--repo")
+    p.add_argument("--key")
     p.add_argument("--password")
     p.add_argument("--target", default="/")
     p.add_argument("--log")
     p.add_argument("--all", action="store_true")
+    p.add_argument(
+        "--sql-stream", action="store_true",
+        help="pipe SQL dumps straight into borg (<archive>.sql), no /tmp "
+             "files; on restore, stream dumps from the archive into mysql/psql"
+    )
+    p.add_argument(
+        "--sql-jobs", type=int, default=0, metavar="N",
+        help="dump/restore each database separately with N parallel workers"
+    )
+    p.add_argument(
+        "--sql-tables", action="store_true",
+        help="per-table dumps ordered by primary key, no dump dates (dedup)"
+    )
+    p.add_argument(
+        "--pg-physical", action="store_true",
+        help="stream pg_basebackup into <archive>.pgbase instead of SQL dumps"
+    )
+    p.add_argument(
+        "--pg-service", default="postgresql",
+        help="systemd unit for physical restore ('' = pg_ctl -D DATADIR)"
+    )
+    p.add_argument("--pg-datadir", help="override PostgreSQL data_directory")
+    p.add_argument(
+        "--mysql-physical", action="store_true",
+        help="stream mariabackup/xtrabackup into <archive>.mysqlbase "
+             "instead of mysqldump"
+    )
+    p.add_argument("--mysql-service", default="mysql")
+    p.add_argument("--mysql-datadir", help="override MySQL datadir")
+    p.add_argument(
+        "--docker", choices=["stop", "dbs", "quiesce", "pause"], default="stop",
+        help="--all: stop the Docker daemon during backup (default); dbs: keep "
+             "it running and dump containerised databases via docker exec; "
+             "quiesce/pause: stop/pause only containers with data in the "
+             "backup set while their volumes are copied"
+    )
+    p.add_argument(
+        "--info", action="store_true",
+        help="after backup also run borg info / list --last 5 (extra repo calls)"
+    )
+    p.add_argument(
+        "--compression", default=COMPRESSION, metavar="SPEC",
+        help="borg compression for the main archive, or 'auto' to pick "
+             "lz4/zstd,N/auto by measured CPU and link speed"
+    )
+    p.add_argument(
+        "--compression-every", type=float, default=7, metavar="DAYS",
+        help="with --compression auto: re-run the benchmark after DAYS"
+    )
+    p.add_argument(
+        "--profile", action="store_true",
+        help="sample borg's /proc stats and classify the run as CPU-, "
+             "read- or network-bound (stored in run.json)"
+    )
+    p.add_argument(
+        "--tag", help="free-form label stored with the run in history.db"
+    )
+    p.add_argument(
+        "--prom-dir", default=PROM_DIR, metavar="DIR",
+        help="node_exporter textfile directory for run metrics "
+             "(skipped if it does not exist; '' disables)"
+    )
+    p.add_argument(
+        "--progress-interval", type=float, default=60, metavar="SEC",
+        help="without a TTY: log a progress summary every SEC seconds"
+    )
+    p.add_argument(
+        "--tail-lines", type=int, default=50, metavar="N",
+        help="without a TTY: last N output lines, printed only on failure"
+    )
+    p.add_argument(
+        "--docker-timeout", type=float, default=120, metavar="SEC",
+        help="deadline for Docker to stop / become ready and healthy"
+    )
+    p.add_argument(
+        "--snapshot", choices=["lvm", "btrfs", "zfs"],
+        help="back up a snapshot of --snapshot-mount and restart services "
+             "right after it"
+    )
+    p.add_argument(
+        "--snapshot-mount", default="/", metavar="DIR",
+        help="mountpoint of the filesystem to snapshot (default /)"
+    )
+    p.add_argument(
+        "--snapshot-size", default="10%ORIGIN",
+        help="LVM snapshot size (lvcreate -L 20G or -l 10%%ORIGIN)"
+    )
+    p.add_argument(
+        "--fsfreeze", action="store_true",
+        help="fsfreeze local filesystems only while --freeze-hook commands "
+             "run and metadata is captured"
+    )
+    p.add_argument(
+        "--freeze-output", metavar="DIR",
+        help="directory inside the backup set where freeze hooks write "
+             "their point-in-time copies; its filesystem is not frozen. "
+             "If the hooks write nothing, Docker is stopped as usual"
+    )
+    p.add_argument(
+        "--freeze-hook", action="append", default=[], metavar="CMD",
+        help="command run while frozen; must not write to frozen filesystems"
+    )
+    p.add_argument(
+        "--freeze-timeout", type=float, default=10, metavar="SEC",
+        help="hard limit for the freeze; filesystems are thawed after it"
+    )
+    p.add_argument(
+        "--store", action="append", default=[], metavar="KIND:TARGET",
+        help="consistent online snapshot of a data store, e.g. "
+             "sqlite:/srv/app/*.db or redis:127.0.0.1:6379 (repeatable)"
+    )
+    p.add_argument(
+        "--sql-full-every", type=float, default=0, metavar="DAYS",
+        help="full SQL dump every DAYS, ship binlog/WAL increments every run"
+    )
+    p.add_argument(
+        "--pg-wal-dir", default=str(PG_WAL_DIR),
+        help="directory filled by PostgreSQL archive_command"
+    )
+    p.add_argument(
+        "--until", metavar="'YYYY-MM-DD HH:MM:SS'",
+        help="restore: replay full dump + increments up to this time"
+    )
     g = p.add_mutually_exclusive_group(required=True)
     g.add_argument("--list", action="store_true")
     g.add_argument("--backup", action="store_true")
     g.add_argument("--restore", action="store_true")
     g.add_argument("--clear-all", action="store_true")
+    g.add_argument(
+        "--report", action="store_true",
+        help="show throughput, dedup and phase trends from history.db"
+    )
     args = p.parse_args()
+    if args.report:
+        report()
+        return
+    if not (args.repo and args.key):
+        p.error("--repo and --key are required")
+    SETTINGS["tag"] = args.tag
 
     log_file = Path.cwd() / args.log if args.log else None
     if log_file:
         log_file.parent.mkdir(exist_ok=True)
 
     setup_logging(log_file)
+    LiveTail.summary_interval = args.progress_interval
+    LiveTail.keep = args.tail_lines
     log(f"Start: {sys.argv}")
 
-    smart_install()
-    env = build_env(args)
-    init_repo(env)
-
-    if args.list:
-        list_archives(env)
-    elif args.clear_all:
-        clear_all(env)
-    elif args.backup:
-        do_backup(env, args.all)
-    elif args.restore:
-        do_restore(env, args.target, args.all)
+    mode = next(
+        m for m in ("list", "clear_all", "backup", "restore") if getattr(args, m)
+    )
+    status = 1
+    try:
+        smart_install()
+        env = build_env(args)
+        init_repo(env)
+
+        if args.list:
+            list_archives(env)
+        elif args.clear_all:
+            clear_all(env)
+        elif args.backup:
+            do_backup(env, args)
+        elif args.restore:
+            do_restore(env, args)
+        status = 0
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+        raise
+    finally:
+        if mode != "list":
+            # Сбой записи метрик не должен подменять код выхода запуска
+            summary = write_run_summary(mode, status)
+            try:
+                write_prom(summary, args.prom_dir)
+            except OSError as e:
+                log(f"⚠️ Prometheus textfile not written: {e}")
+            try:
+                record_run(summary)
+            except sqlite3.Error as e:
+                log(f"⚠️ Run history not recorded: {e}")
 
 
 if __name__ == "__main__":
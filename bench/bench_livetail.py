@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Цена отрисовки live-tail: CPU на миллион строк вывода (как у
+borg extract --list) для прежнего LiveTail и текущего backup.LiveTail.
+
+Вывод в терминал подменён записью в /dev/null с isatty() = True, так что
+меряется разбор и формирование кадров, а не скорость эмулятора:
+
+    bench/bench_livetail.py --lines 1000000
+"""
+import argparse
+import io
+import re
+import sys
+import time
+from collections import deque
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import backup  # noqa: E402
+
+
+class FakeTTY(io.TextIOWrapper):
+    def __init__(self):
+        super().__init__(open("/dev/null", "wb"), write_through=False)
+        self.written = 0
+
+    def isatty(self):
+        return True
+
+    def write(self, s):
+        self.written += len(s)
+        return super().write(s)
+
+
+class LegacyTail:
+    """LiveTail до ограничения частоты кадров: regex и полная перерисовка
+    на каждую строку."""
+
+    def __init__(self, lines=5):
+        self.lines = lines
+        self.buf = deque(maxlen=lines)
+        self.percent = None
+        print("\n" * (lines + 1), end="")
+
+    def update(self, line):
+        line = line.rstrip("\n")
+        if not line:
+            return
+        m = re.search(r"(\d{1,3})%", line)
+        if m:
+            self.percent = m.group(1)
+        self.buf.append(line)
+        sys.stdout.write(f"\033[{self.lines + 1}F")
+        sys.stdout.write("\033[2K")
+        sys.stdout.write(f"Progress: {self.percent or '--'}%\n")
+        buf_list = list(self.buf)
+        for i in range(self.lines):
+            sys.stdout.write("\033[2K")
+            if i < len(buf_list):
+                sys.stdout.write(buf_list[i][:160])
+            sys.stdout.write("\n")
+        sys.stdout.flush()
+
+    def finish(self):
+        pass
+
+
+def feed(tail_cls, lines):
+    real, sys.stdout = sys.stdout, FakeTTY()
+    try:
+        t0 = time.process_time()
+        tail = tail_cls()
+        for i in range(lines):
+            if i % 100 == 0:
+                tail.update(f"{i * 100 / lines:.1f}% Extracting: usr/lib/f{i}.py")
+            tail.update(f"usr/lib/python3/dist-packages/pkg{i % 97}/mod_{i}.py")
+        tail.finish()
+        cpu = time.process_time() - t0
+        written = sys.stdout.written
+    finally:
+        sys.stdout = real
+    return cpu, written
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--lines", type=int, default=1_000_000)
+    args = p.parse_args()
+    scale = 1_000_000 / args.lines
+    for name, cls in (("legacy", LegacyTail), ("LiveTail", backup.LiveTail)):
+        cpu, written = feed(cls, args.lines)
+        print(
+            f"{name:<10} {cpu * scale:7.2f} s CPU / 1M lines, "
+            f"{written * scale / 1e6:8.1f} MB to terminal / 1M lines"
+        )
+
+
+if __name__ == "__main__":
+    main()
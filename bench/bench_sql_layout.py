@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Сколько байт добавляет в репозиторий каждый прогон дампа:
+один файл на сервер (как sql_dump()) против --sql-tables.
+
+Нужны локальные MySQL и/или PostgreSQL и borg. Между прогонами можно
+менять данные командой --mutate, например:
+
+    bench/bench_sql_layout.py --runs 3 \\
+        --mutate "mysql -e 'UPDATE shop.orders SET n = n + 1 WHERE id = 42'"
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import backup  # noqa: E402
+
+
+def borg_added(env, repo, name, path):
+    """deduplicated_size нового архива из borg create --json."""
+    r = subprocess.run(
+        ["borg", "create", "--json", f"{repo}::{name}", "."],
+        env=env, cwd=path, capture_output=True, text=True, check=True
+    )
+    return json.loads(r.stdout)["archive"]["stats"]["deduplicated_size"]
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--runs", type=int, default=3)
+    p.add_argument("--jobs", type=int, default=os.cpu_count())
+    p.add_argument("--mutate", help="shell command run between runs")
+    args = p.parse_args()
+
+    env = os.environ.copy()
+    env["BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK"] = "yes"
+    tmp = Path(tempfile.mkdtemp(prefix="bench-sql-"))
+    tmp.chmod(0o711)  # pg_dump пишет от имени postgres
+    legacy, repos = tmp / "all", {}
+    backup.SQL_DIR = tmp / "tables"
+    for layout in ("all", "tables"):
+        repos[layout] = tmp / f"repo-{layout}"
+        subprocess.run(
+            ["borg", "init", "-e", "none", str(repos[layout])],
+            env=env, check=True
+        )
+
+    rows = []
+    try:
+        for i in range(1, args.runs + 1):
+            if i > 1 and args.mutate:
+                subprocess.run(args.mutate, shell=True, check=True)
+            shutil.rmtree(legacy, ignore_errors=True)
+            legacy.mkdir()
+            for _, name, cmd in backup.sql_dump_commands():
+                subprocess.run(f"{cmd} > {legacy / name}", shell=True, check=True)
+            backup.sql_dump(args.jobs, tables=True)
+            rows.append((
+                i,
+                borg_added(env, repos["all"], f"run{i}", legacy),
+                borg_added(env, repos["tables"], f"run{i}", backup.SQL_DIR)
+            ))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"{'run':>4} {'all-databases':>16} {'--sql-tables':>16}")
+    for i, a, t in rows:
+        print(f"{i:>4} {a:>16,} {t:>16,}")
+    if len(rows) > 1:
+        a = sum(r[1] for r in rows[1:]) / (len(rows) - 1)
+        t = sum(r[2] for r in rows[1:]) / (len(rows) - 1)
+        print(f"avg bytes added after run 1: {a:,.0f} vs {t:,.0f}")
+
+
+if __name__ == "__main__":
+    main()